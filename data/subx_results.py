@@ -1,4 +1,3 @@
-import pickle
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -12,7 +11,9 @@ from torch.utils.data import DataLoader
 import os
 import sys
 
-from src.model import SpatiotemporalLightningModule, torch_rmse
+from src.data import open_store, preprocess, SeedSplit
+from src.lightning_module import SpatiotemporalLightningModule
+from src.model import torch_rmse
 from src.util import NumpyDataset, to_np, to_item, get_device
 
 
@@ -21,16 +22,11 @@ def evaluate_extremes(seed):
 
     # prepare data
     args = argparse.Namespace(seed=seed, n_train=731, n_val=104, batch_size=104)
-    x, y, rand_inds = data["x"], data["y"], data["rand_inds"]
-    x = x[rand_inds[:, args.seed]]
-    y = y[rand_inds[:, args.seed]]
-    original_x = np.copy(x)
-    x = np.log(x + 1)
-    mu_x, sigma_x = np.nanmean(x[:args.n_train + args.n_val]), np.nanstd(x[:args.n_train + args.n_val])
-    x = (x - mu_x) / sigma_x
+    split, (mu_x, sigma_x) = preprocess("subx/all_data", args.seed, args.n_train, args.n_val)
+    raw_split = SeedSplit(data["x"], data["y"], np.asarray(data["rand_inds"])[:, args.seed], args.n_train, args.n_val)
 
     # keep only test set data
-    original_x, x, y = original_x[args.n_train + args.n_val:], x[args.n_train + args.n_val:], y[args.n_train + args.n_val:]
+    original_x, x, y = np.asarray(raw_split.x("test", raw=True)), np.asarray(split.x("test")), np.asarray(split.y("test"))
     test_dataset = NumpyDataset(x, y)
 
     # load models trained on seed 1
@@ -153,8 +149,7 @@ def evaluate_extremes(seed):
 
 if __name__ == "__main__":
 
-    with open("subx/all_data.pickle", "rb") as f:
-        data = pickle.load(f)
+    data = open_store("subx/all_data")
 
     losses = []
     for seed in range(1, 6):
@@ -0,0 +1,456 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+
+MANIFEST_NAME = "manifest.json"
+# bump whenever the contents or layout of preprocessed stores change so that old caches are not reused
+PREPROCESS_VERSION = 2
+
+
+def checksum(a):
+    """
+    Computes the sha1 checksum of the raw bytes of an array
+    """
+    return hashlib.sha1(np.ascontiguousarray(a).tobytes()).hexdigest()
+
+
+def write_store(path, arrays, chunk_size=32, attrs=None):
+    """
+    Writes a dictionary of arrays to a chunked on-disk store. Every array is split along its first (sample) axis
+    into .npy files of chunk_size samples which can later be memory-mapped one chunk at a time. A manifest recording
+    the shape, dtype and per-chunk checksums of every array is written last so a partially written store is never
+    picked up by open_store.
+    Parameters:
+    path - string, directory to write the store to
+    arrays - dictionary, maps array names to arrays (anything supporting len() and slicing along the first axis,
+             the chunks are only materialized one at a time)
+    chunk_size - int, number of samples per chunk
+    attrs - dictionary or None, extra json-serializable metadata to record in the manifest
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = {"arrays": {}, "attrs": {} if attrs is None else attrs}
+    for name, a in arrays.items():
+        if np.ndim(a) == 0:
+            raise ValueError(f"can only store arrays with a sample axis but {name} is a scalar")
+        chunks = []
+        dtype = getattr(a, "dtype", None)
+        for i, start in enumerate(range(0, len(a), chunk_size)):
+            chunk = np.ascontiguousarray(a[start:start + chunk_size])
+            dtype = chunk.dtype
+            file_name = f"{name}.{i:05d}.npy"
+            np.save(os.path.join(path, file_name), chunk)
+            chunks.append({"file": file_name, "sha1": checksum(chunk)})
+        manifest["arrays"][name] = {
+            "shape": list(np.shape(a)),
+            "dtype": np.dtype(dtype).str,
+            "chunk_size": chunk_size,
+            "chunks": chunks
+        }
+    # the store hash identifies the exact contents of the store and is used to key anything derived from it
+    manifest["hash"] = hashlib.sha1("".join(
+        c["sha1"] for name in sorted(manifest["arrays"]) for c in manifest["arrays"][name]["chunks"]
+    ).encode()).hexdigest()
+    tmp_path = os.path.join(path, MANIFEST_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(path, MANIFEST_NAME))
+    return manifest
+
+
+def read_manifest(path):
+    """
+    Reads the manifest of a store written by write_store
+    """
+    with open(os.path.join(path, MANIFEST_NAME), "r") as f:
+        return json.load(f)
+
+
+def open_store(path, verify=False):
+    """
+    Opens a store written by write_store without reading any of its data.
+    Parameters:
+    path - string, directory of the store
+    verify - boolean, if True every chunk is read once and checked against the checksum in the manifest
+
+    Returns:
+    arrays - dictionary, maps array names to lazily loaded ChunkedArrays
+    """
+    manifest = read_manifest(path)
+    arrays = {name: ChunkedArray(path, meta) for name, meta in manifest["arrays"].items()}
+    if verify:
+        for a in arrays.values():
+            a.verify()
+    return arrays
+
+
+def convert_pickle(pickle_path, store_path, chunk_size=32):
+    """
+    One-off conversion of a pickled dictionary of arrays (e.g. all_data.pickle) to a chunked store
+    """
+    with open(pickle_path, "rb") as f:
+        data = pickle.load(f)
+    return write_store(store_path, data, chunk_size=chunk_size)
+
+
+class ChunkedArray:
+    """
+    Read-only, array-like view of one array in a chunked store. Chunks are memory-mapped the first time a sample in
+    them is requested so only the pages that are actually touched are read from disk.
+
+    Indexing follows numpy along the first axis: an integer returns one sample, a contiguous slice returns another
+    (zero-copy) ChunkedArray over the same files, and an integer or boolean index array gathers the requested samples
+    into a new in-memory array.
+    """
+
+    def __init__(self, path, meta, start=0, stop=None):
+        """
+        Parameters:
+        path - string, directory of the store
+        meta - dictionary, this array's entry in the store manifest
+        start - int, first sample of the store array covered by this view
+        stop - int, one past the last sample of the store array covered by this view
+        """
+        self.path = path
+        self.meta = meta
+        self.chunk_size = meta["chunk_size"]
+        self.start = start
+        self.stop = meta["shape"][0] if stop is None else stop
+        self.shape = (self.stop - self.start,) + tuple(meta["shape"][1:])
+        self.dtype = np.dtype(meta["dtype"])
+        self.ndim = len(self.shape)
+        self._chunks = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # memory maps are re-opened lazily rather than pickled (e.g. when sent to a DataLoader worker)
+        state = dict(self.__dict__)
+        state["_chunks"] = {}
+        return state
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.take(np.arange(len(self)))
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            # only the sample axis is handled lazily, any remaining indices are applied to the loaded samples
+            out = self[key[0]]
+            rest = key[1:] if np.ndim(out) < self.ndim else (slice(None),) + key[1:]
+            return np.asarray(out)[rest]
+        if isinstance(key, (int, np.integer)):
+            i = key + len(self) if key < 0 else key
+            if not 0 <= i < len(self):
+                raise IndexError(f"index {key} is out of bounds for axis 0 with size {len(self)}")
+            c, offset = divmod(self.start + i, self.chunk_size)
+            return np.array(self._chunk(c)[offset])
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return ChunkedArray(self.path, self.meta, self.start + start, self.start + max(start, stop))
+            return self.take(np.arange(start, stop, step))
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.nonzero(key)[0]
+        return self.take(key)
+
+    def take(self, inds):
+        """
+        Gathers the samples at the given indices into a new array. Each chunk is visited once no matter how the
+        indices are ordered.
+        """
+        inds = np.asarray(inds, dtype=np.int64)
+        inds = np.where(inds < 0, inds + len(self), inds)
+        if inds.size and (inds.min() < 0 or inds.max() >= len(self)):
+            raise IndexError(f"index out of bounds for axis 0 with size {len(self)}")
+        inds = inds + self.start
+        out = np.empty((len(inds),) + self.shape[1:], dtype=self.dtype)
+        chunk_ids = inds // self.chunk_size
+        for c in np.unique(chunk_ids):
+            sel = np.nonzero(chunk_ids == c)[0]
+            out[sel] = self._chunk(c)[inds[sel] - c * self.chunk_size]
+        return out
+
+    def chunk_bounds(self):
+        """
+        Returns the (start, stop) index ranges of this view which each lie within a single chunk
+        """
+        bounds = []
+        lo = self.start
+        while lo < self.stop:
+            hi = min((lo // self.chunk_size + 1) * self.chunk_size, self.stop)
+            bounds.append((lo - self.start, hi - self.start))
+            lo = hi
+        return bounds
+
+    def verify(self):
+        """
+        Checks every chunk covered by this view against the checksum recorded in the manifest
+        """
+        first, last = self.start // self.chunk_size, (max(self.stop, 1) - 1) // self.chunk_size
+        for c in range(first, last + 1):
+            if checksum(self._chunk(c)) != self.meta["chunks"][c]["sha1"]:
+                raise ValueError(f"checksum mismatch in {self.meta['chunks'][c]['file']} of store {self.path}")
+
+    def _chunk(self, c):
+        """
+        Memory-maps chunk c on first use
+        """
+        if c not in self._chunks:
+            self._chunks[c] = np.load(os.path.join(self.path, self.meta["chunks"][c]["file"]), mmap_mode="r")
+        return self._chunks[c]
+
+
+def gather(base, inds):
+    """
+    Gathers base[inds] along the first axis for either a numpy array or a ChunkedArray
+    """
+    if isinstance(base, ChunkedArray):
+        return base.take(inds)
+    return np.asarray(base)[inds]
+
+
+class IndexView:
+    """
+    Lazy view of base[indices] along the first axis. Nothing is copied until samples are requested, at which point
+    only the requested samples are gathered from base and the (optional) transform is applied to them alone.
+    """
+
+    def __init__(self, base, indices, transform=None):
+        """
+        Parameters:
+        base - array or ChunkedArray, the shared underlying data
+        indices - array of ints, indices of base covered by this view
+        transform - callable or None, applied to every gathered batch of samples
+        """
+        self.base = base
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.transform = transform
+        self.shape = (len(self.indices),) + tuple(base.shape[1:])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            out = self[key[0]]
+            rest = key[1:] if np.ndim(out) < self.ndim else (slice(None),) + key[1:]
+            return out[rest]
+        if isinstance(key, (int, np.integer)):
+            return self[[key]][0]
+        key = np.asarray(key) if not isinstance(key, slice) else key
+        out = gather(self.base, self.indices[key])
+        return out if self.transform is None else self.transform(out)
+
+
+class LogStandardize:
+    """
+    The predictor transform used throughout our experiments: x -> (log(x + 1) - mu) / sigma
+    """
+
+    # bump whenever the transform changes so that preprocessed caches made with the old one are not reused
+    version = "log1p-standardize-1"
+
+    def __init__(self, mu, sigma, dtype=None):
+        """
+        Parameters:
+        mu - scalar, mean of log(x + 1)
+        sigma - scalar, standard deviation of log(x + 1)
+        dtype - numpy dtype or None, if given the output is cast to it
+        """
+        self.mu = mu
+        self.sigma = sigma
+        self.dtype = dtype
+
+    def __call__(self, x):
+        out = (np.log1p(x) - self.mu) / self.sigma
+        return out if self.dtype is None else out.astype(self.dtype)
+
+    @classmethod
+    def fit(cls, x, batch_size=64):
+        """
+        Fits mu and sigma as the nanmean and nanstd of log(x + 1). The moments are accumulated over batches of
+        batch_size samples (merged with Chan et al.'s parallel update) so x is never materialized or copied in full.
+        """
+        n, mean, m2 = 0, 0., 0.
+        for start in range(0, len(x), batch_size):
+            vals = np.log1p(np.asarray(x[start:start + batch_size], dtype=np.float64))
+            vals = vals[~np.isnan(vals)]
+            if vals.size == 0:
+                continue
+            n_b, mean_b = vals.size, vals.mean()
+            m2_b = np.square(vals - mean_b).sum()
+            delta = mean_b - mean
+            mean += delta * n_b / (n + n_b)
+            m2 += m2_b + delta ** 2 * n * n_b / (n + n_b)
+            n += n_b
+        return cls(float(mean), float(np.sqrt(m2 / n)))
+
+
+class SeedSplit:
+    """
+    Train/validation/test split of one random permutation of the data. Every part is an IndexView over the same
+    shared x and y so the permuted, transformed dataset is never materialized, whatever the seed or split.
+    """
+
+    def __init__(self, x, y, perm, n_train, n_val, transform=None, valid_index=None):
+        """
+        Parameters:
+        x - array or ChunkedArray, predictors in their original (unpermuted) order
+        y - array or ChunkedArray, targets in their original (unpermuted) order
+        perm - array of ints, the permutation defining this split (e.g. rand_inds[:, seed])
+        n_train - int, number of training samples
+        n_val - int, number of validation samples. The remaining samples are the test set
+        transform - callable or None, transform applied to batches of x (e.g. a fitted LogStandardize)
+        valid_index - array of ints or None, flat indices of the grid cells of y that are ever non-nan
+        """
+        self.x_base = x
+        self.y_base = y
+        self.transform = transform
+        self.valid_index = valid_index
+        perm = np.asarray(perm, dtype=np.int64)
+        self.parts = {
+            "train": perm[:n_train],
+            "val": perm[n_train:n_train + n_val],
+            "test": perm[n_train + n_val:],
+            "fit": perm[:n_train + n_val]  # samples used to fit the predictor standardization
+        }
+
+    def x(self, part, raw=False):
+        """
+        Returns a view of the predictors of one part of the split ('train', 'val', 'test' or 'fit').
+        If raw is True the transform is not applied.
+        """
+        return self._view(self.x_base, self.parts[part], None if raw else self.transform)
+
+    def y(self, part):
+        """
+        Returns a view of the targets of one part of the split ('train', 'val', 'test' or 'fit')
+        """
+        return self._view(self.y_base, self.parts[part], None)
+
+    def _view(self, base, inds, transform):
+        """
+        Contiguous untransformed parts (e.g. of a preprocessed store) are returned as plain slices of base,
+        everything else as an IndexView
+        """
+        if transform is None and len(inds) and np.array_equal(inds, np.arange(inds[0], inds[0] + len(inds))):
+            return base[inds[0]:inds[0] + len(inds)]
+        return IndexView(base, inds, transform)
+
+    def fit_transform(self):
+        """
+        Fits the log + standardization transform on the train and validation predictors and sets it as this split's
+        transform
+        """
+        self.transform = LogStandardize.fit(self.x("fit", raw=True))
+        return self.transform
+
+
+def compute_valid_index(y, batch_size=64):
+    """
+    Computes the flat indices (into the last two, spatial, dims) of the grid cells where y is non-nan in at least one
+    sample. The nan pattern of the target is a static land/sea mask, so gathering only these cells removes the
+    invalid cells from every loss and metric computation without changing their values.
+    """
+    valid = np.zeros(y.shape[-2:], dtype=bool)
+    for start in range(0, len(y), batch_size):
+        chunk = ~np.isnan(np.asarray(y[start:start + batch_size]))
+        valid |= chunk.reshape((-1,) + valid.shape).any(axis=0)
+    return np.flatnonzero(valid)
+
+
+def _is_cached(cache_path, key):
+    """
+    Checks whether cache_path holds a complete preprocessed store for key
+    """
+    return os.path.exists(os.path.join(cache_path, MANIFEST_NAME)) and read_manifest(cache_path)["attrs"].get("key") == key
+
+
+def preprocess(path, seed, n_train, n_val, chunk_size=32):
+    """
+    Returns the seed's split of the store at path with the log + standardization transform already applied.
+    The transformed float32 arrays are computed once per (store hash, seed, n_train, n_val, transform version),
+    written in split order (train, val, test) to a chunked store under path/preprocessed/ and reused by every later
+    call with the same key. A changed source store or transform produces a different key so a stale cache is never
+    read. The store is built in a temporary directory and renamed into place, so jobs preprocessing the same key
+    at the same time never see or overwrite each other's partially written files.
+    Parameters:
+    path - string, directory of the source store (which must contain x, y and rand_inds)
+    seed - int, column of rand_inds defining the permutation
+    n_train - int, number of training samples
+    n_val - int, number of validation samples
+    chunk_size - int, number of samples per chunk of the preprocessed store
+
+    Returns:
+    split - SeedSplit, split over the preprocessed store whose parts are zero-copy slices. Its valid_index is the
+            dataset's valid-pixel index (see compute_valid_index), stored with the preprocessed data
+    stats - tuple, (mu_x, sigma_x) used to standardize log(x + 1)
+    """
+    key = {
+        "version": PREPROCESS_VERSION,
+        "source": read_manifest(path)["hash"],
+        "seed": int(seed),
+        "n_train": int(n_train),
+        "n_val": int(n_val),
+        "transform": LogStandardize.version,
+        "dtype": "float32"
+    }
+    cache_path = os.path.join(path, "preprocessed", hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest())
+    if not _is_cached(cache_path, key):
+        data = open_store(path)
+        perm = np.asarray(data["rand_inds"])[:, seed]
+        split = SeedSplit(data["x"], data["y"], perm, n_train, n_val)
+        transform = split.fit_transform()
+        transform.dtype = np.float32
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path))
+        try:
+            write_store(tmp_path, {
+                "x": IndexView(data["x"], perm, transform),
+                "y": IndexView(data["y"], perm, lambda y: y.astype(np.float32)),
+                "valid_index": compute_valid_index(data["y"])
+            }, chunk_size=chunk_size, attrs={"key": key, "mu_x": transform.mu, "sigma_x": transform.sigma})
+            try:
+                os.rename(tmp_path, cache_path)
+            except OSError:
+                # another job finished the same store first, keep its copy (which may already be memory-mapped)
+                if not _is_cached(cache_path, key):
+                    # a stale partial store left by an interrupted writer
+                    shutil.rmtree(cache_path, ignore_errors=True)
+                    os.rename(tmp_path, cache_path)
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except BaseException:
+            # never leave a partial store behind (e.g. on a full disk or a keyboard interrupt)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+    attrs = read_manifest(cache_path)["attrs"]
+    cached = open_store(cache_path)
+    split = SeedSplit(cached["x"], cached["y"], np.arange(len(cached["x"])), n_train, n_val,
+                      valid_index=np.asarray(cached["valid_index"]))
+    return split, (attrs["mu_x"], attrs["sigma_x"])
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument("pickle_path", type=str, help="Pickled dictionary of arrays, e.g. ../data/subx/all_data.pickle")
+    parser.add_argument("store_path", type=str, help="Directory to write the chunked store to, e.g. ../data/subx/all_data")
+    parser.add_argument("--chunk_size", default=32, type=int, help="Number of samples per chunk")
+    args = parser.parse_args()
+
+    manifest = convert_pickle(args.pickle_path, args.store_path, chunk_size=args.chunk_size)
+    for name, meta in manifest["arrays"].items():
+        print(f"{name}: shape={tuple(meta['shape'])}, dtype={meta['dtype']}, chunks={len(meta['chunks'])}")
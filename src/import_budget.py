@@ -0,0 +1,47 @@
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# packages that must only be imported by the functions that need them, never by `import model`
+HEAVY_PACKAGES = ["scipy", "sklearn", "pytorch_lightning", "matplotlib", "wandb", "pandas"]
+
+# runs in a fresh interpreter so nothing is already cached in sys.modules
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import torch
+torch_time = time.perf_counter() - start
+start = time.perf_counter()
+import model
+model_time = time.perf_counter() - start
+heavy = [p for p in {heavy} if p in sys.modules]
+print(torch_time, model_time, ",".join(heavy))
+"""
+
+if __name__ == "__main__":
+
+    """
+    Measures the cold-start cost of `import model` (on top of `import torch`, which it can't avoid) and checks it
+    against a budget. Exits with a non-zero status if the budget is exceeded or a heavy package is imported.
+    """
+
+    parser = ArgumentParser()
+    parser.add_argument("--budget", default=0.25, type=float, help="Maximum seconds `import model` may add to `import torch`")
+    parser.add_argument("--repeats", default=3, type=int, help="Number of fresh interpreters to time (the fastest is reported)")
+    args = parser.parse_args()
+
+    results = []
+    for _ in range(args.repeats):
+        out = subprocess.run([sys.executable, "-c", PROBE.format(heavy=HEAVY_PACKAGES)], capture_output=True,
+                             text=True, check=True).stdout.split()
+        results.append((float(out[0]), float(out[1]), out[2].split(",") if len(out) > 2 else []))
+    torch_time, model_time, heavy = min(results, key=lambda r: r[1])
+    print(f"import torch: {torch_time:.3f}s, import model on top: {model_time:.3f}s (budget {args.budget:.3f}s)")
+
+    if heavy:
+        print(f"FAIL: import model imported {', '.join(heavy)}")
+        sys.exit(1)
+    if model_time > args.budget:
+        print("FAIL: over budget")
+        sys.exit(1)
+    print("OK")
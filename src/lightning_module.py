@@ -0,0 +1,196 @@
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+from model import ExtremeTime2
+from model import SpatiotemporalModel
+from model import make_cnn
+from util import PatchSampler
+from util import SkillMaps
+from util import StreamingMetrics
+from util import get_device
+from util import receptive_field_halo
+
+
+class SpatiotemporalLightningModule(pl.LightningModule):
+
+    def __init__(self, st_params, model_params, seed, lr, n_epoch, patch_size=None, n_patches=1, autocast=None,
+                 loss_scale=1.):
+        """
+        Parameters:
+        st_params - dictionary, parameters of the SpatiotemporalModel
+        model_params - dictionary, parameters of the model backbone
+        seed - int, random seed
+        lr - scalar, learning rate
+        n_epoch - int, number of epochs
+        patch_size - int or None, if given training uses random spatial patches of this size (cnn backbone only)
+        n_patches - int, number of patches cropped from every training sample
+        autocast - string or None, 'bfloat16' or 'float16' runs the backbone in mixed precision while the constraints
+                   and likelihood stay in float32 (see SpatiotemporalModel). Requires st_params["dtype"] 'float32'
+        loss_scale - scalar, static loss scale. The training loss is multiplied by it before the backward pass and
+                     the gradients are divided by it afterwards, which keeps small float16 gradients from flushing
+                     to zero. bfloat16 has the range of float32 and does not need it
+        """
+        super().__init__()
+        self.save_hyperparameters()
+        self.st_params = st_params
+        self.model_params = model_params
+        self.seed = seed
+        self.lr = lr
+        self.n_epoch = n_epoch
+        self.loss_scale = loss_scale
+
+        # build model backbone and spatiotemporal wrapper
+        if st_params["backbone"] == "cnn":
+            model = make_cnn(**model_params).to(get_device())
+        elif st_params["backbone"] == "ding":
+            model = ExtremeTime2(**model_params)
+        else:
+            raise ValueError()
+        self.st_model = SpatiotemporalModel(model=model, autocast=autocast, **st_params).to(get_device())
+        if patch_size is None:
+            self.patch_sampler = None
+        elif st_params["backbone"] == "cnn":
+            self.patch_sampler = PatchSampler(patch_size, receptive_field_halo(model), n_patches)
+        else:
+            raise ValueError("patch training requires a fully convolutional backbone")
+        # optional ThresholdSampler for the variable threshold model, set after construction from training targets
+        self.threshold_sampler = None
+        # metrics are accumulated over the batches of an epoch on the device and computed at its end
+        self.val_metrics = StreamingMetrics().to(get_device())
+        self.test_metrics = StreamingMetrics().to(get_device())
+        # optional per grid cell skill maps of the test epoch, see enable_skill_maps
+        self.test_skill_maps = None
+        self.skill_maps = None
+        pl.seed_everything(self.seed)
+
+    def compile_st_model(self, train_batch, eval_batch=None, **compile_kwargs):
+        """
+        Compiles the SpatiotemporalModel's forward pass and losses with torch.compile and warms up the compiled
+        graphs on example batches, so compilation does not stall the first training and evaluation steps.
+        Parameters:
+        train_batch - dictionary, example training batch (its shapes should match the training batches)
+        eval_batch - dictionary or None, example evaluation batch. Defaults to train_batch
+        compile_kwargs - keyword arguments for torch.compile
+        """
+        self.st_model.compile_graphs(**compile_kwargs)
+        with torch.random.fork_rng():  # warm-up draws random thresholds and patches, keep the seeded stream intact
+            self.st_model.warm_up(*self.prepare_batch(train_batch, train=True), train=True)
+            self.st_model.warm_up(*self.prepare_batch(train_batch if eval_batch is None else eval_batch, train=False),
+                                  train=False)
+
+    def prepare_batch(self, batch, train):
+        """
+        Moves a batch to the device, chooses thresholds and augments the predictors with them if needed
+        Parameters:
+        batch - dictionary, batch with predictors "x" and target "y"
+        train - boolean, if True draws training thresholds and crops patches otherwise uses the fixed quantile
+                threshold
+
+        Returns:
+        x - tensor, predictors
+        threshes - tensor, thresholds
+        y - tensor, target
+        """
+        x = batch["x"].to(self.device, self.st_model.dtype)
+        y = batch["y"].to(self.device, self.st_model.dtype)
+        if not train:
+            # fix threshold at test time and augment predictors if the model uses variable thresholds
+            t = torch.nanquantile(y, self.st_model.quantile)
+            threshes = torch.ones_like(y) * t
+            if self.st_model.variable_thresh:
+                x = torch.cat([x, threshes[:, np.newaxis].repeat(1, 1, x.shape[2], 1, 1)], axis=1)
+            return x, threshes, y
+
+        # choose threshold
+        if self.st_model.variable_thresh:
+            if self.threshold_sampler is not None:
+                # draw random climatological thresholds and augment predictors
+                threshes = self.threshold_sampler(len(y)).to(y.dtype)
+            else:
+                # generate random thresholds in [0.5, 0.95] and augment predictors
+                threshes = 0.45 * torch.rand_like(y) + 0.5
+            x = torch.cat([x, threshes[:, np.newaxis].repeat(1, 1, x.shape[2], 1, 1)], axis=1)
+        else:
+            # generate fixed threshold but do not augment predictors
+            t = torch.nanquantile(y, self.st_model.quantile)
+            threshes = torch.ones_like(y) * t
+
+        # crop random patches (thresholds above are still chosen on the full grid)
+        if self.patch_sampler is not None:
+            x, y, threshes = self.patch_sampler(x, y, threshes)
+        return x, threshes, y
+
+    def training_step(self, batch, batch_idx):
+        self.train()
+        x, threshes, y = self.prepare_batch(batch, train=True)
+
+        # apply appropriate forward pass (logic for each model type is handled in forward() definition
+        pred = self.st_model(x, threshes, test=False)
+
+        loss, nll_loss, rmse_loss = self.st_model.compute_losses(pred, y, threshes)
+        self.log("t_loss", loss)
+        self.log("t_nll_loss", nll_loss)
+        self.log("t_rmse_loss", rmse_loss)  # t for train
+        return loss * self.loss_scale
+
+    def on_after_backward(self):
+        # undo the loss scaling before gradients are clipped or applied
+        if self.loss_scale != 1:
+            for p in self.parameters():
+                if p.grad is not None:
+                    p.grad.div_(self.loss_scale)
+
+    def enable_skill_maps(self, grid_shape, n_bins=10):
+        """
+        Makes test epochs accumulate per grid cell skill maps as well, after the epoch they are stored as a
+        dictionary of (h, w) arrays in self.skill_maps (see SkillMaps)
+        Parameters:
+        grid_shape - tuple of ints, (h, w) of the full grid
+        n_bins - int, number of probability bins of the excess reliability
+        """
+        self.test_skill_maps = SkillMaps(grid_shape, n_bins).to(self.device)
+
+    def evaluation_step(self, batch, metrics, skill_maps=None):
+        self.eval()
+        x, threshes, y = self.prepare_batch(batch, train=False)
+
+        # apply appropriate forward pass (logic for each model type is handled in forward() definition
+        pred = self.st_model(x, threshes, test=True)
+        self.st_model.accumulate_metrics(metrics, y, pred, threshes, skill_maps)
+
+    def on_validation_epoch_start(self):
+        self.val_metrics.reset()
+
+    def validation_step(self, batch, batch_idx):
+        self.evaluation_step(batch, self.val_metrics)
+
+    def validation_epoch_end(self, outputs):
+        for metric_name, metric_value in self.st_model.epoch_metrics(self.val_metrics).items():
+            if "loss" in metric_name:
+                self.log(f"v_{metric_name}", metric_value, prog_bar=True)
+            else:
+                self.log(f"v_{metric_name}", metric_value)  # v for validation
+        self.val_metrics.reset()
+
+    def on_test_epoch_start(self):
+        self.test_metrics.reset()
+        if self.test_skill_maps is not None:
+            self.test_skill_maps.reset()
+
+    def test_step(self, batch, batch_idx):
+        self.evaluation_step(batch, self.test_metrics, self.test_skill_maps)
+
+    def test_epoch_end(self, outputs):
+        for metric_name, metric_value in self.st_model.epoch_metrics(self.test_metrics).items():
+            self.log(f"f_{metric_name}", metric_value)  # f for final
+        self.test_metrics.reset()
+        if self.test_skill_maps is not None:
+            self.skill_maps = self.test_skill_maps.compute()
+            self.test_skill_maps.reset()
+
+    def configure_optimizers(self):
+        return torch.optim.Adam(self.st_model.parameters(), lr=self.lr)
+
+    def n_parameters(self):
+        return sum(p.numel() for p in self.parameters() if p.requires_grad)
@@ -1,4 +1,5 @@
-import pytorch_lightning as pl
+import copy
+
 import torch
 import torch.nn.functional as F
 from torch import Tensor
@@ -7,114 +8,11 @@ from torch import nn
 from util import *
 
 
-class SpatiotemporalLightningModule(pl.LightningModule):
-
-    def __init__(self, st_params, model_params, seed, lr, n_epoch):
-        super().__init__()
-        self.save_hyperparameters()
-        self.st_params = st_params
-        self.model_params = model_params
-        self.seed = seed
-        self.lr = lr
-        self.n_epoch = n_epoch
-
-        # build model backbone and spatiotemporal wrapper
-        if st_params["backbone"] == "cnn":
-            model = make_cnn(**model_params).to(get_device())
-        elif st_params["backbone"] == "ding":
-            model = ExtremeTime2(**model_params)
-        else:
-            raise ValueError()
-        self.st_model = SpatiotemporalModel(model=model, **st_params).to(get_device())
-        pl.seed_everything(self.seed)
-
-    def training_step(self, batch, batch_idx):
-        self.train()
-        x = batch["x"].type(torch.FloatTensor).to(self.device)
-        y = batch["y"].type(torch.FloatTensor).to(self.device)
-
-        # choose threshold
-        if self.st_model.variable_thresh:
-            # generate random thresholds in [0.5, 0.95] and augment predictors
-            threshes = 0.45 * torch.rand_like(y) + 0.5
-            x = torch.cat([x, threshes[:, np.newaxis].repeat(1, 1, x.shape[2], 1, 1)], axis=1)
-        else:
-            # generate fixed threshold but do not augment predictors
-            t = np.nanquantile(to_np(y), self.st_model.quantile)
-            threshes = torch.ones_like(y) * t
-
-        # apply appropriate forward pass (logic for each model type is handled in forward() definition
-        pred = self.st_model(x, threshes, test=False)
-
-        loss, nll_loss, rmse_loss = self.st_model.compute_losses(pred, y, threshes)
-        self.log("t_loss", loss)
-        self.log("t_nll_loss", nll_loss)
-        self.log("t_rmse_loss", rmse_loss)  # t for train
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        self.eval()
-        x = batch["x"].type(torch.FloatTensor).to(self.device)
-        y = batch["y"].type(torch.FloatTensor).to(self.device)
-
-        # choose threshold
-        if self.st_model.variable_thresh:
-            # fix threshold at test time and augment predictors
-            t = np.nanquantile(to_np(y), self.st_model.quantile)
-            threshes = torch.ones_like(y) * t
-            x = torch.cat([x, threshes[:, np.newaxis].repeat(1, 1, x.shape[2], 1, 1)], axis=1)
-        else:
-            # generate fixed threshold but do not augment predictors
-            t = np.nanquantile(to_np(y), self.st_model.quantile)
-            threshes = torch.ones_like(y) * t
-
-        # apply appropriate forward pass (logic for each model type is handled in forward() definition
-        pred = self.st_model(x, threshes, test=True)
-
-        metrics = to_item(self.st_model.compute_metrics(y, pred, threshes))
-        return {
-            "loss": metrics[0],
-            "nll_loss": metrics[1],
-            "rmse_loss": metrics[2],
-            "zero_brier": metrics[3],
-            "moderate_brier": metrics[4],
-            "excess_brier": metrics[5],
-            "acc": metrics[6],
-            "f1_micro": metrics[7],
-            "f1_macro": metrics[8],
-            "auc_macro_ovo": metrics[9],
-            "auc_macro_ovr": metrics[10]
-        }
-
-    def validation_epoch_end(self, outputs):
-        metric_names = outputs[0].keys()
-        for metric_name in metric_names:
-            metric_mean = np.mean([o[metric_name] for o in outputs])
-            if "loss" in metric_name:
-                self.log(f"v_{metric_name}", metric_mean, prog_bar=True)
-            else:
-                self.log(f"v_{metric_name}", metric_mean)  # v for validation
-
-    def test_step(self, batch, batch_idx):
-        return self.validation_step(batch, batch_idx)
-
-    def test_epoch_end(self, outputs):
-        metric_names = outputs[0].keys()
-        for metric_name in metric_names:
-            metric_mean = np.mean([o[metric_name] for o in outputs])
-            self.log(f"f_{metric_name}", metric_mean)  # f for final
-
-    def configure_optimizers(self):
-        return torch.optim.Adam(self.st_model.parameters(), lr=self.lr)
-
-    def n_parameters(self):
-        return sum(p.numel() for p in self.parameters() if p.requires_grad)
-
-
 class SpatiotemporalModel(nn.Module):
 
     def __init__(self, model, use_evt, moderate_func, ymax, mean_multiplier, dropout_multiplier, continuous_evt,
-                 variable_thresh, quantile, use_mc, mc_forwards, backbone, deterministic, ev_index):
+                 variable_thresh, quantile, use_mc, mc_forwards, backbone, deterministic, ev_index, dtype="float32",
+                 crps_multiplier=0., autocast=None):
         """
         Initialize spatiotemporal model.
         Parameters:
@@ -133,11 +31,25 @@ class SpatiotemporalModel(nn.Module):
         backbone - str, type of model used
         deterministic - bool, true for use with Vandal et al and Ding et al
         ev_index - float, extreme value index hyperparameter in Ding et al
+        dtype - string, floating point type of the parameters, inputs and likelihood computations. Must be 'float32'
+                or 'float64'. Only this model is affected, the process-wide default dtype is left alone
+        crps_multiplier - scalar, the weight of the CRPS term added to the loss function
+        autocast - string or None, if 'bfloat16' or 'float16' the backbone runs under autocast in that precision
+                   (mixed precision). Its output is cast back to dtype, which must be 'float32', so the constraints,
+                   likelihood and metrics are computed in full precision
         """
         super().__init__()
-        set_default_tensor_type()
-        self.model = model
+        if dtype not in ("float32", "float64"):
+            raise ValueError("dtype must be 'float32' or 'float64'")
+        self.dtype = getattr(torch, dtype)
+        if autocast not in (None, "bfloat16", "float16"):
+            raise ValueError("autocast must be None, 'bfloat16' or 'float16'")
+        if autocast is not None and dtype != "float32":
+            raise ValueError("autocast requires dtype 'float32'")
+        self.autocast_dtype = None if autocast is None else getattr(torch, autocast)
+        self.model = model.to(self.dtype)
         self.mean_multiplier = mean_multiplier
+        self.crps_multiplier = crps_multiplier
         self.dropout_multiplier = dropout_multiplier
         self.moderate_func = moderate_func
         self.use_evt = use_evt
@@ -152,18 +64,89 @@ class SpatiotemporalModel(nn.Module):
         if self.continuous_evt:
             assert use_evt
         self.ymax = ymax
+        # optional valid-pixel index, see set_valid_index
+        self.register_buffer("valid_index", None, persistent=False)
+        self.grid_shape = None
+        # print diagnostics when predictions contain nans. Checking requires a host sync so it is turned off
+        # for compiled graphs, see compile_graphs
+        self.check_nans = True
+        self._compiled = {}
+
+    def set_valid_index(self, valid_index, grid_shape):
+        """
+        Sets the dataset's valid-pixel index. Losses and metrics on full grids of grid_shape are then computed on
+        dense vectors of the valid cells only.
+        Parameters:
+        valid_index - array of ints, flat indices of the grid cells that are not always nan
+        grid_shape - tuple of ints, (h, w) of the full grid
+        """
+        self.valid_index = torch.as_tensor(np.asarray(valid_index), dtype=torch.long, device=get_device())
+        self.grid_shape = tuple(grid_shape)
+
+    def gather_valid(self, pred, y, threshes):
+        """
+        Gathers the valid cells of the predictions, target and thresholds if a valid-pixel index is set and they
+        cover the full grid (e.g. not for patches during patch training). Otherwise returns them unchanged.
+        """
+        if self.valid_index is None or tuple(y.shape[-2:]) != self.grid_shape:
+            return pred, y, threshes
+        if isinstance(pred, (list, tuple)):
+            pred = type(pred)(gather_valid(p, self.valid_index) for p in pred)
+        else:
+            pred = gather_valid(pred, self.valid_index)
+        return pred, gather_valid(y, self.valid_index), gather_valid(threshes, self.valid_index)
+
+    def compile_graphs(self, **compile_kwargs):
+        """
+        Compiles the forward pass and the losses with torch.compile. Compilation happens lazily on the first call
+        for every new input shape and mode, so call warm_up afterwards to pay for it before training or inference.
+        Parameters:
+        compile_kwargs - keyword arguments for torch.compile (e.g. mode="max-autotune" or fullgraph=True)
+        """
+        self.check_nans = False
+        self._compiled = {
+            "forward": torch.compile(self._forward, **compile_kwargs),
+            "compute_losses": torch.compile(self._compute_losses, **compile_kwargs),
+        }
+
+    def warm_up(self, x, threshes, y, train):
+        """
+        Runs one forward pass and loss computation (and backward pass if train) on an example batch so that the
+        compiled graphs for these input shapes exist before they are needed. Parameters, their gradients and batch
+        norm statistics are left unchanged.
+        Parameters:
+        x - tensor, example predictors
+        threshes - tensor, example thresholds
+        y - tensor, example target
+        train - boolean, if True warms up the training graphs otherwise the evaluation graphs
+        """
+        state, training = copy.deepcopy(self.state_dict()), self.training
+        grads = [p.grad for p in self.parameters()]
+        self.train(train)
+        with torch.set_grad_enabled(train):
+            pred = self(x, threshes, test=not train)
+            loss = self.compute_losses(pred, y, threshes)[0]
+            if train:
+                loss.backward()
+        for p, grad in zip(self.parameters(), grads):
+            p.grad = grad
+        self.load_state_dict(state)
+        self.train(training)
 
     def forward(self, x, threshes, test=False):
+        return self._compiled.get("forward", self._forward)(x, threshes, test)
+
+    def _forward(self, x, threshes, test=False):
         if self.use_mc:
             # output (n, 6, h, w) tensor of distribution parameters
             return self.compute_mc_stats(x, threshes, self.mc_forwards, test)
         elif self.deterministic and not self.use_evt:
             # output (n, 1, h, w) tensor of predicted values
-            pred = self.model(x, test).squeeze(2)
+            pred = self.run_backbone(x, test).squeeze(2)
             return torch.relu(pred)                 # in deterministic precipitation prediction, all values >= 0
         elif self.deterministic and self.use_evt:
             # output (n, 2, h, w) of (predicted values, predicted probability of excesses)
-            pred = self.model(x, test)
+            pred = self.run_backbone(x, test)
             pred[:, 0] = torch.relu(pred[:, 0])         # all predicted values >= 0
             pred[:, 1] = torch.sigmoid(pred[:, 1])      # all predicted probabilities in [0, 1]
             return pred
@@ -171,6 +154,18 @@ class SpatiotemporalModel(nn.Module):
             # output (n, 6, h, w) tensor of distribution parameters
             return self.compute_stats(x, threshes, test)
 
+    def run_backbone(self, x, test=False):
+        """
+        Runs the backbone, under autocast if mixed precision is enabled. The raw output is returned in the model's
+        dtype so everything computed from it (constraints, likelihood, metrics) stays in full precision.
+        Parameters:
+        x - tensor, predictors
+        test - boolean, passed on to the backbone
+        """
+        with torch.autocast(x.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
+            raw = self.model(x, test)
+        return raw.to(self.dtype)
+
     def effective_thresh(self, threshes):
         """
         The effective threshold is the threshold to be used by the mixture model. If we're not using EVT
@@ -222,8 +217,8 @@ class SpatiotemporalModel(nn.Module):
         gpd_pred - tensor, GPD parameters -- gpd_pred[:, 0] is xi and gpd_pred[:, 1] is sigma
         norm_pred - tensor, lognormal parameters -- norm_pred[:, 0] is mu, norm_pred[:, 1] is variance
         """
-        cur_raw = self.model(x, test)
-        if np.isnan(to_np(cur_raw)).any():
+        cur_raw = self.run_backbone(x, test)
+        if self.check_nans and torch.isnan(cur_raw).any():
             print('nans encountered')
         bin_pred, gpd_pred, norm_pred = self._to_stats(cur_raw, threshes)
         return bin_pred, gpd_pred, norm_pred
@@ -259,6 +254,24 @@ class SpatiotemporalModel(nn.Module):
         bin_pred, gpd_pred, norm_pred = pred
         return bin_pred, gpd_pred, norm_pred
 
+    def mixture_params(self, pred, threshes):
+        """
+        Wraps probabilistic predictions in a MixtureParams object which memoizes the terms shared by the losses,
+        point predictions and class probabilities. Pass it in place of pred to share them across calls with the
+        same thresholds. Returns pred unchanged if it already is a MixtureParams object.
+        Parameters:
+        pred - list of tensors or MixtureParams, mixture model parameters
+        threshes - tensor, thresholds
+
+        Returns:
+        params - MixtureParams, mixture model parameters with the effective and actual thresholds
+        """
+        if isinstance(pred, MixtureParams):
+            return pred
+        bin_pred, gpd_pred, norm_pred = self.split_pred(pred)
+        return MixtureParams(bin_pred, gpd_pred, norm_pred, self.effective_thresh(threshes), threshes,
+                             self.moderate_func)
+
     def compute_losses(self, pred, y, threshes):
         """
         Computes NLK, RMSE, and their weighted sum.
@@ -268,11 +281,18 @@ class SpatiotemporalModel(nn.Module):
         threshes - tensor, thresholds
 
         Returns:
-        loss - tensor, this is the weighted average of NLK and RMSE. This is the loss used for training
-               so it can be back-propogated
+        loss - tensor, this is the weighted average of NLK and RMSE plus the weighted CRPS. This is the loss used for
+               training so it can be back-propogated
         predicted_logliks - array, negative log-likelihood
         rmse_loss - array, MSE of point predictions
         """
+        return self._compiled.get("compute_losses", self._compute_losses)(pred, y, threshes)
+
+    def _compute_losses(self, pred, y, threshes):
+        """
+        Uncompiled implementation of compute_losses
+        """
+        pred, y, threshes = self.gather_valid(pred, y, threshes)
         if self.deterministic and not self.use_evt:
             # deterministic model loss
             # output (n, 1, h, w) tensor of predicted values
@@ -281,31 +301,19 @@ class SpatiotemporalModel(nn.Module):
         elif self.deterministic and self.use_evt:
             # Ding et al. model loss
             # output (n, 2, h, w) of (predicted values, predicted probability of excesses)
-            point_pred, excess_pred = pred[:, [0]], pred[:, [1]]
-            excess_true = 1. * (y > self.effective_thresh(threshes))
+            point_pred = pred[:, [0]]
             rmse_loss = torch_rmse(y, point_pred)
-            beta_0, beta_1 = self.quantile, 1 - self.quantile
-            nll_loss = torch.nanmean(
-                -beta_0 * (1 - excess_pred / self.ev_index)**self.ev_index * excess_true * torch.log(excess_pred) + \
-                -beta_1 * (1 - (1 - excess_pred) / self.ev_index)**self.ev_index * (1 - excess_true) * torch.log(1 - excess_pred)
-            )
+            nll_loss = torch.nanmean(self._evl_terms(y, pred, threshes))
         else:
             # probabilistic model loss
             # output (n, 6, h, w) tensor of distribution parameters
+            pred = self.mixture_params(pred, threshes)
             rmse_loss = self.compute_rmse(y, pred, threshes)
-            bin_pred, gpd_pred, norm_pred = self.split_pred(pred)
-            # I'm pretty sure this line was necessary to gpd_pred later on for debugging purposes. I don't think
-            # its needed now but decided to keep it just in case.
-            gpd_pred = split_var(gpd_pred)
-            nll_loss = -torch_nanmean(
-                loglik(
-                    y, gpd_pred, norm_pred, bin_pred[:, 0], bin_pred[:, 1], self.effective_thresh(threshes),
-                    self.moderate_func
-                )
-            )
+            nll_loss = -torch_nanmean(pred.loglik(y))
 
         loss = (1 - self.mean_multiplier) * nll_loss + self.mean_multiplier * rmse_loss + \
-               (0 if (self.dropout_multiplier == 0) else (self.dropout_multiplier * self.model.regularisation()))
+               (0 if (self.dropout_multiplier == 0) else (self.dropout_multiplier * self.model.regularisation())) + \
+               (0 if (self.crps_multiplier == 0) else (self.crps_multiplier * self.compute_crps(y, pred, threshes)))
         return loss, nll_loss, rmse_loss
 
     def compute_point_pred(self, pred, threshes):
@@ -320,11 +328,60 @@ class SpatiotemporalModel(nn.Module):
         else:
             # probabilistic model
             # output (n, 6, h, w) of predicted parameters
-            bin_pred, gpd_pred, moderate_pred = self.split_pred(pred)
-            point_pred = all_mean(gpd_pred, moderate_pred, bin_pred[:, 0], bin_pred[:, 1],
-                                  self.effective_thresh(threshes), self.moderate_func)
+            point_pred = self.mixture_params(pred, threshes).point_pred
         return point_pred
 
+    def compute_quantiles(self, pred, threshes, q):
+        """
+        Computes quantiles of the predicted mixture distributions (e.g. for return levels or percentile maps)
+        Parameters:
+        pred - list of tensors, list of mixture model parameters
+        threshes - tensor, thresholds
+        q - array-like or tensor of shape (K,), quantile levels in [0, 1]
+
+        Returns:
+        quantiles - tensor of shape (K,) + threshes.shape, predicted quantiles at every level
+        """
+        if self.deterministic:
+            raise ValueError('quantiles require a probabilistic model')
+        bin_pred, gpd_pred, moderate_pred = self.split_pred(pred)
+        return all_ppf(q, bin_pred, gpd_pred, moderate_pred, self.effective_thresh(threshes))
+
+    def compute_exceedance_probs(self, pred, threshes, levels):
+        """
+        Computes the predicted probabilities of exceeding several precipitation levels (e.g. 10, 25, 50 and 100 mm)
+        in one broadcasted pass that stays on the device (see all_sf)
+        Parameters:
+        pred - list of tensors, list of mixture model parameters
+        threshes - tensor, thresholds
+        levels - array-like or tensor of shape (K,) or (K, h, w), levels shared by all pixels or given per pixel
+
+        Returns:
+        probs - tensor of shape (K,) + threshes.shape, predicted exceedance probabilities at every level
+        """
+        if self.deterministic:
+            raise ValueError('exceedance probabilities require a probabilistic model')
+        return self.mixture_params(pred, threshes).exceedance(levels)
+
+    def sample_scenarios(self, pred, threshes, n_samples, chunk_size=100, seed=None):
+        """
+        Draws random precipitation scenarios from the predicted mixture distributions in chunks (see sample_mixture)
+        Parameters:
+        pred - list of tensors, list of mixture model parameters
+        threshes - tensor, thresholds
+        n_samples - int, number of scenarios
+        chunk_size - int, number of scenarios generated at once
+        seed - int or None, seed of the random number generator
+
+        Yields:
+        scenarios - tensor of shape (m,) + threshes.shape with m <= chunk_size, the next m scenarios
+        """
+        if self.deterministic:
+            raise ValueError('scenarios require a probabilistic model')
+        bin_pred, gpd_pred, moderate_pred = self.split_pred(pred)
+        return sample_mixture(bin_pred, gpd_pred, moderate_pred, self.effective_thresh(threshes), n_samples,
+                              chunk_size, seed)
+
     def compute_metrics(self, y, pred, threshes):
         """
         Computes a wide range of evaluation metrics
@@ -345,7 +402,10 @@ class SpatiotemporalModel(nn.Module):
         f1_macro - scalar, f1 macro of all classes
         auc_macro_ovo - scalar, auc macro one versus one
         auc_macro_ovr - scalar, auc macro one versus all
+        crps - scalar, mean continuous ranked probability score
+        All scalars are 0-d tensors on the device of the predictions, see to_item
         """
+        pred, y, threshes = self.gather_valid(pred, y, threshes)
         if self.deterministic and not self.use_evt:
             # deterministic model loss
             # output (n, 1, h, w) tensor of predicted values
@@ -354,32 +414,82 @@ class SpatiotemporalModel(nn.Module):
         elif self.deterministic and self.use_evt:
             # Ding et al. model loss
             # output (n, 2, h, w) of (predicted values, predicted probability of excesses)
-            point_pred, excess_pred = pred[:, [0]], pred[:, [1]]
-            excess_true = 1. * (y > self.effective_thresh(threshes))
+            point_pred = pred[:, [0]]
             rmse_loss = torch_rmse(y, point_pred)
-            beta_0, beta_1 = self.quantile, 1 - self.quantile
-            nll_loss = torch.nanmean(
-                -beta_0 * (1 - excess_pred / self.ev_index)**self.ev_index * excess_true * torch.log(excess_pred) + \
-                -beta_1 * (1 - (1 - excess_pred) / self.ev_index)**self.ev_index * (1 - excess_true) * torch.log(1 - excess_pred)
-            )
+            nll_loss = torch.nanmean(self._evl_terms(y, pred, threshes))
         else:
-            # probabilistic model metrics
+            # probabilistic model metrics, the class metrics below reuse the memoized terms of pred
+            pred = self.mixture_params(pred, threshes)
             rmse_loss = self.compute_rmse(y, pred, threshes)
-            bin_pred, gpd_pred, norm_pred = self.split_pred(pred)
-            nll_loss = -torch_nanmean(
-                loglik(
-                    y, gpd_pred, norm_pred, bin_pred[:, 0], bin_pred[:, 1], self.effective_thresh(threshes),
-                    self.moderate_func
-                )
-            )
+            nll_loss = -torch_nanmean(pred.loglik(y))
 
         zero_brier, moderate_brier, excess_brier, acc, f1_micro, f1_macro, auc_macro_ovo, auc_macro_ovr = \
             self.compute_class_metrics(y, pred, threshes)
 
+        crps_loss = self.compute_crps(y, pred, threshes)
         loss = nll_loss + self.mean_multiplier * rmse_loss + \
-               (0 if (self.dropout_multiplier == 0) else (self.dropout_multiplier * self.model.regularisation()))
-        return to_np(loss), to_np(nll_loss), to_np(
-            rmse_loss), zero_brier, moderate_brier, excess_brier, acc, f1_micro, f1_macro, auc_macro_ovo, auc_macro_ovr
+               (0 if (self.dropout_multiplier == 0) else (self.dropout_multiplier * self.model.regularisation())) + \
+               self.crps_multiplier * crps_loss
+        return loss, nll_loss, rmse_loss, zero_brier, moderate_brier, excess_brier, acc, f1_micro, f1_macro, \
+            auc_macro_ovo, auc_macro_ovr, crps_loss
+
+    def _evl_terms(self, y, pred, threshes):
+        """
+        Elementwise extreme value loss of Ding et al. for the predicted probabilities of excesses
+        """
+        excess_pred = pred[:, [1]]
+        excess_true = 1. * (y > self.effective_thresh(threshes))
+        beta_0, beta_1 = self.quantile, 1 - self.quantile
+        return -beta_0 * (1 - excess_pred / self.ev_index)**self.ev_index * excess_true * torch.log(excess_pred) + \
+            -beta_1 * (1 - (1 - excess_pred) / self.ev_index)**self.ev_index * (1 - excess_true) * torch.log(1 - excess_pred)
+
+    def accumulate_metrics(self, metrics, y, pred, threshes, skill_maps=None):
+        """
+        Adds the sufficient statistics of a batch's evaluation metrics to a StreamingMetrics accumulator. Everything
+        stays on the device, see epoch_metrics for the metrics of all accumulated batches
+        Parameters:
+        metrics - StreamingMetrics, the accumulator
+        y - tensor, target variable
+        pred - list of tensors, list of mixture model parameters
+        threshes - tensor, thresholds
+        skill_maps - SkillMaps or None, if given the per grid cell statistics are accumulated as well, from the same
+                     class probabilities, point predictions and log-likelihood terms
+        """
+        gathered = self.valid_index is not None and tuple(y.shape[-2:]) == self.grid_shape
+        pred, y, threshes = self.gather_valid(pred, y, threshes)
+        if self.deterministic and not self.use_evt:
+            nll = 0 * y     # zero with the nans of y
+        elif self.deterministic and self.use_evt:
+            nll = self._evl_terms(y, pred, threshes)
+        else:
+            pred = self.mixture_params(pred, threshes)
+            nll = -pred.loglik(y)
+        point_pred = self.compute_point_pred(pred, threshes).reshape(y.shape)
+        crps_terms = torch.abs(y - point_pred) if self.deterministic else pred.crps(y)
+        probs = torch.stack(self._class_probs(pred, threshes))
+        metrics.update(y, threshes, probs, point_pred, nll, crps_terms)
+        if skill_maps is not None:
+            if gathered:
+                skill_maps.update(y, threshes, probs, point_pred, nll, cells=self.valid_index)
+            else:
+                skill_maps.update(*(a.flatten(-2) for a in (y, threshes, probs, point_pred, nll)))
+
+    def epoch_metrics(self, metrics):
+        """
+        Computes the evaluation metrics of all batches added to a StreamingMetrics accumulator, together with the
+        loss as in compute_metrics
+        Parameters:
+        metrics - StreamingMetrics, the accumulator
+
+        Returns:
+        values - dictionary of floats, loss, nll_loss, rmse_loss, zero_brier, moderate_brier, excess_brier, acc,
+                 f1_micro, f1_macro, auc_macro_ovo, auc_macro_ovr and crps
+        """
+        values = metrics.compute()
+        loss = values["nll_loss"] + self.mean_multiplier * values["rmse_loss"] + \
+            (0 if (self.dropout_multiplier == 0) else (self.dropout_multiplier * float(self.model.regularisation()))) + \
+            self.crps_multiplier * values["crps"]
+        return {"loss": loss, **values}
 
     def compute_brier_scores(self, y, pred, threshes):
         """
@@ -394,18 +504,7 @@ class SpatiotemporalModel(nn.Module):
         moderate_brier - scalar, brier score for non-zero non-excess class
         excess_brier - scalar, brier score for excess class
         """
-        # Compute true class labels
-        true_zero = to_np((y == 0) * 1.)
-        true_excess = to_np((y > threshes) * 1.)
-        true_moderate = to_np(1 - true_zero - true_excess)
-
-        # Compute predicted probabilities
-        pred_zero, pred_moderate, pred_excess = self.compute_all_probs(pred, threshes, aslist=True)
-
-        zero_brier = brier_score(true_zero, pred_zero)
-        moderate_brier = brier_score(true_moderate, pred_moderate)
-        excess_brier = brier_score(true_excess, pred_excess)
-        return zero_brier, moderate_brier, excess_brier
+        return brier_scores(compute_class_labels(y, threshes), torch.stack(self._class_probs(pred, threshes)))
 
     def compute_all_probs(self, pred, threshes, aslist):
         """
@@ -415,41 +514,47 @@ class SpatiotemporalModel(nn.Module):
         threshes - tensor, thresholds
         aslist - boolean, if True returns results as a list of arrays if False stacks the arrays into one large array
         """
+        if aslist:
+            return tuple(map(to_np, self._class_probs(pred, threshes)))
+        else:
+            # stack on the device so the probabilities are copied to the host at once
+            return to_np(torch.stack(self._class_probs(pred, threshes)))
+
+    def _class_probs(self, pred, threshes):
+        """
+        Tensor version of compute_all_probs, returns the probabilities of the 3 classes as a tuple of tensors
+        """
         if self.deterministic and not self.use_evt:
             # compute hard estimates
-            pred_zero = to_np(torch.where(pred == 0, 1, 0))
-            pred_excess = to_np(torch.where(pred > threshes, 1, 0))
-            pred_moderate = to_np(1 - pred_zero - pred_excess)
+            pred_zero = torch.where(pred == 0, 1., 0.)
+            pred_excess = torch.where(pred > threshes, 1., 0.)
+            pred_moderate = 1 - pred_zero - pred_excess
         elif self.deterministic and self.use_evt:
             # compute soft estimates
             point_pred, excess_pred = pred[:, [0]], pred[:, [1]]
-            pred_zero = to_np(torch.where(point_pred == 0, 1, 0))[:, 0]
-            pred_excess = to_np(torch.where(point_pred != 0, 1, 0) * excess_pred)[:, 0]
-            pred_moderate = to_np(1 - pred_zero - pred_excess)
+            pred_zero = torch.where(point_pred == 0, 1., 0.)[:, 0]
+            pred_excess = (torch.where(point_pred != 0, 1., 0.) * excess_pred)[:, 0]
+            pred_moderate = 1 - pred_zero - pred_excess
         else:
             # compute soft estimates
-            pred_zero = self.compute_zero_prob(pred)
-            pred_excess = self.compute_excess_prob(pred, threshes)
-            pred_moderate = self.compute_moderate_prob(pred, threshes)
-        if aslist:
-            return pred_zero, pred_moderate, pred_excess
-        else:
-            return np.stack([pred_zero, pred_moderate, pred_excess], axis=0)
+            pred_zero, pred_moderate, pred_excess = self.mixture_params(pred, threshes).class_probs
+        return pred_zero, pred_moderate, pred_excess
 
-    def compute_class(self, pred, threshes):
+    def compute_class(self, pred, threshes, probs=None):
         """
         Determines the predicted class (zero, non-zero non-excess, or excess)
         Parameters:
         pred - list of tensors, list of mixture model parameters
         threshes - tensor, thresholds
+        probs - tensor or None, stacked class probabilities if already computed
 
         Returns:
-        labels - array, predicted class labels
+        labels - int8 tensor, predicted class labels
         """
         # predicted classes are (0=zero, 1=nonzero-nonexcess, 2=excess)
-        probs = self.compute_all_probs(pred, threshes, aslist=False)
-        labels = np.argmax(probs, axis=0)
-        return labels
+        if probs is None:
+            probs = torch.stack(self._class_probs(pred, threshes))
+        return compute_predicted_labels(probs)
 
     def compute_class_metrics(self, y, pred, threshes):
         """
@@ -469,14 +574,16 @@ class SpatiotemporalModel(nn.Module):
         auc_macro_ovo - scalar, auc macro one versus one
         auc_macro_ovr - scalar, auc macro one versus all
         """
-        pred_probs = self.compute_all_probs(pred, threshes, aslist=True)
-        pred_labels = self.compute_class(pred, threshes)
+        # the (3, ...) stack of class probabilities and the true labels are computed once and shared by all metrics,
+        # everything stays on the device
+        pred_probs = torch.stack(self._class_probs(pred, threshes))
+        pred_labels = compute_predicted_labels(pred_probs)
         true_labels = compute_class_labels(y, threshes)
 
         acc = accuracy(true_labels, pred_labels)
         f1_micro, f1_macro = f1(true_labels, pred_labels)
-        auc_macro_ovo, auc_macro_ovr = auc(true_labels, np.stack(pred_probs, axis=0))
-        zero_brier, moderate_brier, excess_brier = self.compute_brier_scores(y, pred, threshes)
+        auc_macro_ovo, auc_macro_ovr = auc(true_labels, pred_probs)
+        zero_brier, moderate_brier, excess_brier = brier_scores(true_labels, pred_probs)
         return zero_brier, moderate_brier, excess_brier, acc, f1_micro, f1_macro, auc_macro_ovo, auc_macro_ovr
 
     def compute_zero_prob(self, pred):
@@ -511,7 +618,7 @@ class SpatiotemporalModel(nn.Module):
         Returns:
         bin_pred - array, probability of non-zero non-excess rainfall
         """
-        return to_np(1 - self.compute_zero_prob(pred) - self.compute_excess_prob(pred, threshes))
+        return to_np(self.mixture_params(pred, threshes).class_probs[1])
 
     def compute_excess_prob(self, pred, threshes):
         """
@@ -522,9 +629,7 @@ class SpatiotemporalModel(nn.Module):
         Returns:
         bin_pred - array, probability of excess rainfall
         """
-        bin_pred, gpd_pred, norm_pred = self.split_pred(pred)
-        return to_np((1 - all_cdf(threshes, gpd_pred, norm_pred, bin_pred[:, 0], bin_pred[:, 1],
-                                  self.effective_thresh(threshes), threshes, self.moderate_func)))
+        return to_np(self.mixture_params(pred, threshes).class_probs[2])
 
     def compute_loglik(self, y, pred, threshes):
         """
@@ -534,11 +639,7 @@ class SpatiotemporalModel(nn.Module):
         pred - list of tensors, list of mixture model parameters
         threshes - tensor, thresholds
         """
-        bin_pred, gpd_pred, norm_pred = self.split_pred(pred)
-        return loglik(
-            y[:, 0], gpd_pred, norm_pred, bin_pred[:, 0], bin_pred[:, 1], self.effective_thresh(threshes),
-            self.moderate_func
-        )
+        return self.mixture_params(pred, threshes).loglik(y[:, 0])
 
     def compute_rmse(self, y, pred, threshes):
         """
@@ -548,13 +649,25 @@ class SpatiotemporalModel(nn.Module):
         pred - list of tensors, list of mixture model parameters
         threshes - tensor, thresholds
         """
-        bin_pred, gpd_pred, moderate_pred = self.split_pred(pred)
-        point_pred = all_mean(gpd_pred, moderate_pred, bin_pred[:, 0], bin_pred[:, 1],
-                              self.effective_thresh(threshes), self.moderate_func)
-        if torch.isnan(point_pred).any():
+        point_pred = self.mixture_params(pred, threshes).point_pred
+        if self.check_nans and torch.isnan(point_pred).any():
             print("nan here")
         return torch_rmse(y, point_pred)
 
+    def compute_crps(self, y, pred, threshes):
+        """
+        Computes the mean continuous ranked probability score of the predictions. It is computed in closed form for
+        probabilistic models (see crps) and reduces to the mean absolute error for deterministic models
+        Parameters:
+        y - tensor, target variable
+        pred - list of tensors, list of mixture model parameters
+        threshes - tensor, thresholds
+        """
+        if self.deterministic:
+            point_pred = self.compute_point_pred(pred, threshes)
+            return torch_nanmean(torch.abs(y - point_pred.reshape(y.shape)))
+        return torch_nanmean(self.mixture_params(pred, threshes).crps(y))
+
     def _mc_forwards(self, x, threshes, n_forwards, test=False):
         """
         Compute n_forwards forward passes through network with dropout and returns stacked predictions.
@@ -1,19 +1,20 @@
-import pickle
+import os
 from argparse import ArgumentParser
 
+import numpy as np
 import pytorch_lightning as pl
-import torch
-from torch.utils.data import DataLoader
 
 import wandb
-from model import SpatiotemporalLightningModule
-from util import get_device, NumpyDataset
+from data import open_store
+from lightning_module import SpatiotemporalLightningModule
+from util import get_device, batch_dataloader
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
     parser = pl.Trainer.add_argparse_args(parser)
     parser.add_argument("--name", default="1z1h5m58", type=str, help="Name of wandb run")
+    parser.add_argument("--skill_maps", default=False, type=eval, help="Whether to also compute per grid cell skill maps, saved next to the best checkpoint as skill_maps.npz")
     args = parser.parse_args()
     print(f"Starting run with args: {args}")
 
@@ -23,18 +24,17 @@ if __name__ == "__main__":
     run = api.run(f"andrewmcdonald/demm/{args.name}")
 
     # configure data
-    with open("../data/subx/processed_data.pickle", "rb") as f:
-        data = pickle.load(f)
+    data = open_store("../data/subx/processed_data")
     x, y = data["x"], data["y"]
 
     # configure dataloaders
-    test_dataset = NumpyDataset(x[run.config["n_train"] + run.config["n_val"]:], y[run.config["n_train"] + run.config["n_val"]:])
-    test_dataloader = DataLoader(test_dataset, batch_size=run.config["batch_size"], num_workers=4)
+    test_dataloader = batch_dataloader(x[run.config["n_train"] + run.config["n_val"]:],
+                                       y[run.config["n_train"] + run.config["n_val"]:], run.config["batch_size"])
 
     # load model from best checkpoint
     best_model_path = run.config["best_model_path"]
     lightning_module = SpatiotemporalLightningModule.load_from_checkpoint(best_model_path)
-    lightning_module.to(device=get_device(), dtype=torch.float)
+    lightning_module.to(get_device())
 
     # wandb logging
     wandb_logger = pl.loggers.WandbLogger(project="demm")
@@ -46,5 +46,11 @@ if __name__ == "__main__":
 
     # test
     print(f"Starting testing with {best_model_path}.")
+    if args.skill_maps:
+        lightning_module.enable_skill_maps(y.shape[-2:])
     trainer.test(lightning_module, test_dataloader)
+    if args.skill_maps:
+        skill_maps_path = os.path.join(os.path.dirname(best_model_path), "skill_maps.npz")
+        np.savez(skill_maps_path, **lightning_module.skill_maps)
+        print(f"Saved skill maps to {skill_maps_path}.")
     print(f"Done testing.")
@@ -1,16 +1,14 @@
-import pickle
-import torch
+import os
+
 import numpy as np
-import matplotlib.pyplot as plt
 import pytorch_lightning as pl
 
-import wandb
 from argparse import ArgumentParser
-from torch.utils.data import DataLoader
 from pytorch_lightning.callbacks import ModelCheckpoint
 
-from model import SpatiotemporalLightningModule
-from util import get_device, NumpyDataset
+from data import preprocess
+from lightning_module import SpatiotemporalLightningModule
+from util import get_device, batch_dataloader, streaming_dataloader, ThresholdSampler
 
 
 if __name__ == "__main__":
@@ -27,6 +25,7 @@ if __name__ == "__main__":
     
     mean_multiplier - scalar, weight to assign MSE loss term (the other loss term is NLK)
     dropout_multiplier - scalar, weight for dropout regularization in Vandal et al implementation
+    crps_multiplier - scalar, weight to assign CRPS loss term
     quantile - scalar, what quantile to use to define the excess threshold. If variable_thresh is True then the threshold
                determined by quantile will only be used for evaluation purposes while the mixture model's threshold
                will be random.
@@ -58,6 +57,7 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", default=104, type=int, help="Batch size to train with")
     parser.add_argument("--mean_multiplier", default=0.9, type=float, help="Weight assigned to RMSE loss term (1 - complement is weight assigned to NLL term (probabilistic models) or EVL term (Ding et al.)).")
     parser.add_argument("--dropout_multiplier", default=1e-2, type=float, help="Weight assigned to dropout loss term in Vandal baseline")
+    parser.add_argument("--crps_multiplier", default=0., type=float, help="Weight assigned to CRPS loss term (added to the NLL/RMSE loss)")
     parser.add_argument("--quantile", default=0.6, type=float, help="Quantile used to define excess threshold in proposed model; used only for evaluation if variable threshold model")
     parser.add_argument("--continuous_evt", default=False, type=eval, help="Whether to constrain mixture to be continuous; appealing in theory but performs poorly in practice")
     parser.add_argument("--ev_index", default=1.0, type=float, help="Extreme value index hyperparameter for Ding et al")
@@ -68,25 +68,39 @@ if __name__ == "__main__":
     parser.add_argument("--n_epoch", default=200, type=int, help="Number of epochs")
     parser.add_argument("--seed", default=1, type=int, help="Random seed")
     parser.add_argument("--lr", default=1e-4, type=float, help="Learning rate")
+    parser.add_argument("--climatology_thresh", default=False, type=eval, help="Whether the variable threshold model draws its random training thresholds from per-pixel climatological quantiles in [0.5, 0.95]")
+    parser.add_argument("--patch_size", default=None, type=int, help="If given, train the CNN on random spatial patches of this size")
+    parser.add_argument("--n_patches", default=1, type=int, help="Number of patches cropped from every training sample")
+    parser.add_argument("--streaming", default=False, type=eval, help="Whether to stream training batches from disk with background prefetching (for data larger than memory)")
+    parser.add_argument("--shuffle_buffer", default=512, type=int, help="Number of samples in the shuffle buffer when streaming")
+    parser.add_argument("--device_resident", default=False, type=eval, help="Whether to keep each data split on the training device and draw batches by on-device indexing")
+    parser.add_argument("--dtype", default="float32", type=str, help="Floating point type of the model and its likelihood computations", choices=["float32", "float64"])
+    parser.add_argument("--autocast", default=None, type=str, help="Runs the CNN backbone under autocast in this precision while the constraints and likelihood stay in float32 (requires --dtype float32)", choices=["bfloat16", "float16"])
+    parser.add_argument("--loss_scale", default=1., type=float, help="Static loss scale for mixed precision training (useful with float16 autocast)")
+    parser.add_argument("--compile", default=False, type=eval, help="Whether to compile the model's forward pass and losses with torch.compile (warmed up before training)")
+    parser.add_argument("--compile_cache", default=None, type=str, help="Directory for torch.compile's on-disk kernel cache so later runs warm up faster")
+    parser.add_argument("--skill_maps", default=False, type=eval, help="Whether testing also computes per grid cell skill maps, saved next to the best checkpoint as skill_maps.npz")
     args = parser.parse_args()
     args.max_epochs = args.n_epoch
     print(f"Starting run with args: {args}")
+    if args.compile_cache is not None:
+        # inductor reads its cache directory once per process, so it is set before anything is compiled
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = args.compile_cache
 
     # configure data with log-transform, standardization on x, and random shuffle
-    with open("../data/subx/all_data.pickle", "rb") as f:
-        data = pickle.load(f)
-    x, y, rand_inds = data["x"], data["y"], data["rand_inds"]
-    x = x[rand_inds[:, args.seed]]
-    y = y[rand_inds[:, args.seed]]
-    x = np.log(x + 1)
-    mu_x, sigma_x = np.nanmean(x[:args.n_train + args.n_val]), np.nanstd(x[:args.n_train + args.n_val])
-    x = (x - mu_x) / sigma_x
-    train_dataset = NumpyDataset(x[:args.n_train], y[:args.n_train])
-    val_dataset = NumpyDataset(x[args.n_train:args.n_train + args.n_val], y[args.n_train:args.n_train + args.n_val])
-    test_dataset = NumpyDataset(x[args.n_train + args.n_val:], y[args.n_train + args.n_val:])
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=1, shuffle=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, num_workers=1)
-    test_dataloader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=1)
+    # (computed once per seed and split, then reused from the preprocessed cache next to the data)
+    split, (mu_x, sigma_x) = preprocess("../data/subx/all_data", args.seed, args.n_train, args.n_val)
+    device = get_device() if args.device_resident else None
+    if args.streaming and args.device_resident:
+        raise ValueError("streaming and device resident data are mutually exclusive")
+    elif args.streaming:
+        train_dataloader = streaming_dataloader(split.x("train"), split.y("train"), args.batch_size, shuffle=True,
+                                                shuffle_buffer=args.shuffle_buffer)
+    else:
+        train_dataloader = batch_dataloader(split.x("train"), split.y("train"), args.batch_size, shuffle=True,
+                                            device=device)
+    val_dataloader = batch_dataloader(split.x("val"), split.y("val"), args.batch_size, device=device)
+    test_dataloader = batch_dataloader(split.x("test"), split.y("test"), args.batch_size, device=device)
 
     # configure parameters of model backbone (3D CNN or GRU) and spatiotemporal model
     model_params = {
@@ -106,6 +120,7 @@ if __name__ == "__main__":
         "ymax": 250,
         "mean_multiplier": args.mean_multiplier,
         "dropout_multiplier": args.dropout_multiplier,
+        "crps_multiplier": args.crps_multiplier,
         "continuous_evt": args.continuous_evt,
         "quantile": args.quantile,
         "variable_thresh": False,
@@ -113,7 +128,8 @@ if __name__ == "__main__":
         "mc_forwards": 0,
         "backbone": "cnn",
         "deterministic": False,
-        "ev_index": args.ev_index
+        "ev_index": args.ev_index,
+        "dtype": args.dtype
     }
 
     # tweak parameters depending on model choice
@@ -151,15 +167,25 @@ if __name__ == "__main__":
 
     # configure lightning module wrapper
     lightning_module = SpatiotemporalLightningModule(st_params=st_params, model_params=model_params,
-                                                     seed=args.seed, lr=args.lr, n_epoch=args.max_epochs)
+                                                     seed=args.seed, lr=args.lr, n_epoch=args.max_epochs,
+                                                     patch_size=args.patch_size, n_patches=args.n_patches,
+                                                     autocast=args.autocast, loss_scale=args.loss_scale)
+    if args.climatology_thresh:
+        lightning_module.threshold_sampler = ThresholdSampler(split.y("train"))
+    grid_shape = split.y("train").shape[-2:]
+    lightning_module.st_model.set_valid_index(split.valid_index, grid_shape)
+    if args.compile:
+        lightning_module.compile_st_model(next(iter(train_dataloader)), next(iter(val_dataloader)))
 
     # wandb logging
+    import wandb
     wandb.init(project="demm", group=args.model)
     if args.wandb_name != "default":
         wandb.run.name = args.wandb_name  # continue logging on previous run
     wandb_logger = pl.loggers.WandbLogger(project="demm", group=args.model)
     wandb_logger.watch(lightning_module, log="all", log_freq=50)
     wandb_logger.experiment.config.update(args)
+    wandb_logger.experiment.config.update({"mu_x": mu_x, "sigma_x": sigma_x})
 
     # trainer configuration
     trainer = pl.Trainer.from_argparse_args(args)
@@ -180,6 +206,16 @@ if __name__ == "__main__":
     # test with best validation loss model
     print(f"Starting testing with {checkpoint_callback.best_model_path}.")
     lightning_module = SpatiotemporalLightningModule.load_from_checkpoint(checkpoint_callback.best_model_path)
-    lightning_module.to(device=get_device(), dtype=torch.float)
+    lightning_module.to(get_device())
+    lightning_module.st_model.set_valid_index(split.valid_index, grid_shape)
+    if args.compile:
+        lightning_module.compile_st_model(next(iter(train_dataloader)), next(iter(test_dataloader)))
+    if args.skill_maps:
+        lightning_module.enable_skill_maps(grid_shape)
     trainer.test(lightning_module, test_dataloader)
+    if args.skill_maps:
+        skill_maps_path = os.path.join(os.path.dirname(checkpoint_callback.best_model_path), "skill_maps.npz")
+        np.savez(skill_maps_path, **lightning_module.skill_maps)
+        wandb_logger.experiment.config.update({"skill_maps_path": skill_maps_path})
+        print(f"Saved skill maps to {skill_maps_path}.")
     print(f"Done testing.")
@@ -1,13 +1,12 @@
-import pickle
 from argparse import ArgumentParser
 
 import numpy as np
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import DataLoader
 
-from model import SpatiotemporalModel, ExtremeTime2, get_device, make_cnn, to_np
-from util import NumpyDataset
+from model import SpatiotemporalModel, ExtremeTime2, get_device, make_cnn, to_item, to_np
+from data import open_store
+from util import batch_dataloader
 
 if __name__ == "__main__":
 
@@ -23,6 +22,7 @@ if __name__ == "__main__":
     
     mean_multiplier - scalar, weight to assign MSE loss term (the other loss term is NLK)
     dropout_multiplier - scalar, weight for dropout regularization in Vandal et al implementation
+    crps_multiplier - scalar, weight to assign CRPS loss term
     quantile - scalar, what quantile to use to define the excess threshold. If variable_thresh is True then the threshold
                determined by quantile will only be used for evaluation purposes while the mixture model's threshold
                will be random.
@@ -54,6 +54,7 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", default=50, type=int, help="Batch size to train with")
     parser.add_argument("--mean_multiplier", default=0.9, type=float, help="Weight assigned to RMSE loss term (1 - complement is weight assigned to NLL term (probabilistic models) or EVL term (Ding et al.)).")
     parser.add_argument("--dropout_multiplier", default=1e-2, type=float, help="Weight assigned to dropout loss term in Vandal baseline")
+    parser.add_argument("--crps_multiplier", default=0., type=float, help="Weight assigned to CRPS loss term (added to the NLL/RMSE loss)")
     parser.add_argument("--quantile", default=0.6, type=float, help="Quantile used to define excess threshold in proposed model; used only for evaluation if variable threshold model")
     parser.add_argument("--continuous_evt", default=False, type=eval, help="Whether to constrain mixture to be continuous; appealing in theory but performs poorly in practice")
     parser.add_argument("--ev_index", default=1.0, type=float, help="Extreme value index hyperparameter for Ding et al")
@@ -69,11 +70,9 @@ if __name__ == "__main__":
     print(f"Starting run with args: {args}")
 
     # configure data
-    with open("../data/subx/processed_data.pickle", "rb") as f:
-        data = pickle.load(f)
+    data = open_store("../data/subx/processed_data")
     x, y = data["x"], data["y"]
-    train_dataset = NumpyDataset(x[:args.n_train], y[:args.n_train])
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=1)
+    train_dataloader = batch_dataloader(x[:args.n_train], y[:args.n_train], args.batch_size)
 
     # configure parameters of model backbone (3D CNN or GRU) and spatiotemporal model
     model_params = {
@@ -93,6 +92,7 @@ if __name__ == "__main__":
         "ymax": 250,
         "mean_multiplier": args.mean_multiplier,
         "dropout_multiplier": args.dropout_multiplier,
+        "crps_multiplier": args.crps_multiplier,
         "continuous_evt": args.continuous_evt,
         "quantile": args.quantile,
         "variable_thresh": False,
@@ -153,8 +153,8 @@ if __name__ == "__main__":
     print(f"Starting training.")
     for batch in train_dataloader:
         st_model.train()
-        x = batch["x"].type(torch.FloatTensor).to(device)
-        y = batch["y"].type(torch.FloatTensor).to(device)
+        x = batch["x"].to(device, st_model.dtype)
+        y = batch["y"].to(device, st_model.dtype)
 
         # choose threshold
         if st_model.variable_thresh:
@@ -186,8 +186,8 @@ if __name__ == "__main__":
     print(f"Starting testing.")
     for batch in train_dataloader:
         st_model.eval()
-        x = batch["x"].type(torch.FloatTensor).to(device)
-        y = batch["y"].type(torch.FloatTensor).to(device)
+        x = batch["x"].to(device, st_model.dtype)
+        y = batch["y"].to(device, st_model.dtype)
 
         # choose threshold
         if st_model.variable_thresh:
@@ -202,7 +202,7 @@ if __name__ == "__main__":
         # apply appropriate forward pass (logic for each model type is handled in forward() definition
         pred = st_model(x, threshes, test=True)
         loss, nll_loss, rmse_loss = st_model.compute_losses(pred, y, threshes)
-        metrics = st_model.compute_metrics(y, pred, threshes)
+        metrics = to_item(st_model.compute_metrics(y, pred, threshes))
         print("*" * 100)
         print("f_loss", loss)
         print("f_nll_loss", nll_loss)
@@ -218,7 +218,8 @@ if __name__ == "__main__":
                            "f1_micro": metrics[7],
                            "f1_macro": metrics[8],
                            "auc_macro_ovo": metrics[9],
-                           "auc_macro_ovr": metrics[10]
+                           "auc_macro_ovr": metrics[10],
+                           "crps": metrics[11]
                            }
         for metric_name, metric_value in labeled_metrics.items():
             print(f"f_{metric_name}", metric_value)
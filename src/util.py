@@ -1,16 +1,19 @@
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import torch.nn.functional as F
-from scipy.stats import genpareto
-from scipy.stats import pearsonr
-from sklearn.metrics import f1_score
-from sklearn.metrics import roc_auc_score
 from torch import nn
+from torch.utils.data import BatchSampler
+from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
+from torch.utils.data import IterableDataset
+from torch.utils.data import RandomSampler
+from torch.utils.data import Sampler
+from torch.utils.data import SequentialSampler
 
-import model as m
 
 
 class NumpyDataset(Dataset):
@@ -26,6 +29,362 @@ class NumpyDataset(Dataset):
         return {"x": self.x[i], "y": self.y[i]}
 
 
+class BatchDataset(Dataset):
+    """
+    Dataset whose items are whole batches rather than single samples. Indexed with the list of sample indices
+    yielded by a BatchSampler it gathers all of them from x and y in one go (a single slice when they are contiguous)
+    and returns them already converted to tensors of the requested dtype, so there is no per-sample collation.
+
+    If a device is given the whole dataset is converted and moved to that device once up front, and batches are then
+    gathered on device with the index tensors yielded by a DeviceBatchSampler.
+    """
+
+    def __init__(self, x, y, dtype=torch.float, device=None):
+        """
+        Parameters:
+        x - array-like, predictors (numpy array, ChunkedArray or IndexView)
+        y - array-like, targets
+        dtype - torch dtype, dtype of the returned tensors
+        device - torch device or None, if given the dataset is kept resident on this device
+        """
+        self.dtype = dtype
+        self.device = device
+        if device is None:
+            self.x = x
+            self.y = y
+        else:
+            self.x = torch.tensor(np.asarray(x), dtype=dtype, device=device)
+            self.y = torch.tensor(np.asarray(y), dtype=dtype, device=device)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, inds):
+        if torch.is_tensor(self.x):
+            # device-resident data, the gather creates new tensors so batches never alias the dataset
+            inds = torch.as_tensor(inds, device=self.x.device)
+            return {"x": self.x[inds], "y": self.y[inds]}
+        # order within a batch doesn't matter so indices are sorted to read the underlying data in order
+        inds = np.sort(np.atleast_1d(np.asarray(inds, dtype=np.int64)))
+        if len(inds) and inds[-1] - inds[0] + 1 == len(inds):
+            inds = slice(inds[0], inds[-1] + 1)
+        # torch.tensor always copies so batches never alias the dataset (some metrics modify their inputs in place)
+        return {"x": torch.tensor(np.asarray(self.x[inds]), dtype=self.dtype),
+                "y": torch.tensor(np.asarray(self.y[inds]), dtype=self.dtype)}
+
+
+class DeviceBatchSampler(Sampler):
+    """
+    Batch sampler that draws the epoch's permutation directly on the device and yields each batch of indices as a
+    tensor on that device. Used with a device-resident BatchDataset.
+    """
+
+    def __init__(self, n, batch_size, shuffle, device, drop_last=False):
+        """
+        Parameters:
+        n - int, number of samples
+        batch_size - int, number of samples per batch
+        shuffle - boolean, if True samples are reshuffled every epoch
+        device - torch device, device to create the indices on
+        drop_last - boolean, if True the last incomplete batch is dropped
+        """
+        self.n = n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        if self.shuffle:
+            inds = torch.randperm(self.n, device=self.device)
+        else:
+            inds = torch.arange(self.n, device=self.device)
+        for batch in torch.split(inds, self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                break
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n // self.batch_size
+        return math.ceil(self.n / self.batch_size)
+
+
+def batch_dataloader(x, y, batch_size, shuffle=False, dtype=torch.float, drop_last=False, device=None):
+    """
+    Makes a DataLoader that yields whole batches gathered by a BatchDataset
+    Parameters:
+    x - array-like, predictors
+    y - array-like, targets
+    batch_size - int, number of samples per batch
+    shuffle - boolean, if True samples are reshuffled every epoch
+    dtype - torch dtype, dtype of the returned tensors
+    drop_last - boolean, if True the last incomplete batch is dropped
+    device - torch device or None, if given the whole dataset is moved to this device once and batches are drawn
+             by on-device indexing (no host to device copies per batch)
+    """
+    dataset = BatchDataset(x, y, dtype, device)
+    if device is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        sampler = BatchSampler(sampler, batch_size, drop_last)
+    else:
+        sampler = DeviceBatchSampler(len(dataset), batch_size, shuffle, device, drop_last)
+    return DataLoader(dataset, sampler=sampler, batch_size=None)
+
+
+class StreamingDataset(IterableDataset):
+    """
+    Streams batches from on-disk data with constant memory, for datasets too large to hold in RAM. The data is read
+    in pieces that each lie within one chunk of the store; a pool of background threads reads pieces ahead into a
+    bounded prefetch queue, and with shuffling on the piece order is permuted every epoch and samples are drawn at
+    random from a shuffle buffer of bounded size.
+    """
+
+    def __init__(self, x, y, batch_size, shuffle=False, shuffle_buffer=512, n_threads=2, prefetch=4,
+                 dtype=torch.float, drop_last=False, piece_size=32):
+        """
+        Parameters:
+        x - array-like, predictors. ChunkedArrays are read chunk by chunk, anything else in pieces of piece_size
+        y - array-like, targets
+        batch_size - int, number of samples per batch
+        shuffle - boolean, if True pieces are read in a random order and batches drawn from a shuffle buffer
+        shuffle_buffer - int, number of samples held in the shuffle buffer
+        n_threads - int, number of background threads reading pieces
+        prefetch - int, maximum number of pieces read ahead of the consumer
+        dtype - torch dtype, dtype of the returned tensors
+        drop_last - boolean, if True the last incomplete batch is dropped
+        piece_size - int, number of samples per piece when x has no chunk layout
+        """
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.n_threads = n_threads
+        self.prefetch = prefetch
+        self.dtype = dtype
+        self.drop_last = drop_last
+        self.piece_size = piece_size
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.x) // self.batch_size
+        return math.ceil(len(self.x) / self.batch_size)
+
+    def pieces(self):
+        """
+        Returns (start, stop) ranges covering the data such that no range crosses a chunk boundary of x or y
+        """
+        edges = {0, len(self.x)}
+        for a in (self.x, self.y):
+            if hasattr(a, "chunk_bounds"):
+                edges.update(lo for lo, hi in a.chunk_bounds())
+            else:
+                edges.update(range(0, len(a), self.piece_size))
+        edges = sorted(edges)
+        return list(zip(edges[:-1], edges[1:]))
+
+    def _read(self, piece):
+        lo, hi = piece
+        return np.asarray(self.x[lo:hi]), np.asarray(self.y[lo:hi])
+
+    def _stream_pieces(self, rng):
+        """
+        Yields the pieces in order (shuffled if requested) while background threads read ahead
+        """
+        pieces = self.pieces()
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            # each DataLoader worker streams its own share of the pieces
+            pieces = pieces[worker_info.id::worker_info.num_workers]
+        if self.shuffle:
+            pieces = [pieces[i] for i in rng.permutation(len(pieces))]
+        executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        pending = deque()
+        try:
+            for piece in pieces:
+                pending.append(executor.submit(self._read, piece))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _to_batch(self, x, y):
+        return {"x": torch.tensor(x, dtype=self.dtype), "y": torch.tensor(y, dtype=self.dtype)}
+
+    def __iter__(self):
+        rng = np.random.default_rng(np.random.randint(2 ** 31))
+        buffer_size = max(self.shuffle_buffer, self.batch_size) if self.shuffle else self.batch_size
+        # preallocated buffer whose first count slots hold samples, drawn slots are refilled from the end of the
+        # buffer (swap-remove) so every batch copies only batch_size samples
+        buf_x, buf_y, count = None, None, 0
+        for x, y in self._stream_pieces(rng):
+            if buf_x is None:
+                buf_x = np.empty((buffer_size,) + x.shape[1:], dtype=x.dtype)
+                buf_y = np.empty((buffer_size,) + y.shape[1:], dtype=y.dtype)
+            start = 0
+            while start < len(x):
+                n = min(len(x) - start, buffer_size - count)
+                buf_x[count:count + n], buf_y[count:count + n] = x[start:start + n], y[start:start + n]
+                count, start = count + n, start + n
+                if count == buffer_size:
+                    if self.shuffle:
+                        sel = rng.choice(count, self.batch_size, replace=False)
+                    else:
+                        sel = np.arange(self.batch_size)
+                    yield self._to_batch(buf_x[sel], buf_y[sel])
+                    count = self._remove(buf_x, buf_y, count, sel)
+        # flush whatever is left in the buffer
+        order = rng.permutation(count) if self.shuffle else np.arange(count)
+        for start in range(0, len(order), self.batch_size):
+            sel = order[start:start + self.batch_size]
+            if self.drop_last and len(sel) < self.batch_size:
+                break
+            yield self._to_batch(buf_x[sel], buf_y[sel])
+
+    @staticmethod
+    def _remove(buf_x, buf_y, count, sel):
+        """
+        Removes the samples at sel from the first count slots of the buffers by moving the last samples that are not
+        removed into the freed slots, returns the new count
+        """
+        keep = count - len(sel)
+        removed = np.zeros(count, dtype=bool)
+        removed[sel] = True
+        holes, tail = np.flatnonzero(removed[:keep]), keep + np.flatnonzero(~removed[keep:])
+        buf_x[holes], buf_y[holes] = buf_x[tail], buf_y[tail]
+        return keep
+
+
+def streaming_dataloader(x, y, batch_size, shuffle=False, **kwargs):
+    """
+    Makes a DataLoader over a StreamingDataset (see StreamingDataset for the keyword arguments)
+    """
+    return DataLoader(StreamingDataset(x, y, batch_size, shuffle=shuffle, **kwargs), batch_size=None)
+
+
+def receptive_field_halo(model):
+    """
+    Computes how many cells the spatial receptive field of a fully convolutional model extends past the output cell
+    on each side, i.e. the sum of dilation * (kernel_size - 1) / 2 over the spatial dims of its Conv3d layers.
+    Assumes stride 1 and 'same' spatial padding as in the CNN backbone.
+    Returns:
+    halo - tuple of ints, halo along height and width
+    """
+    halo = [0, 0]
+    for module in model.modules():
+        if isinstance(module, nn.Conv3d):
+            if any(s != 1 for s in module.stride[1:]):
+                raise ValueError("only stride 1 convolutions are supported")
+            for i in range(2):
+                halo[i] += module.dilation[i + 1] * (module.kernel_size[i + 1] - 1) // 2
+    return tuple(halo)
+
+
+class PatchSampler:
+    """
+    Crops random spatial patches from a batch for training a fully convolutional model on large grids. Cells within
+    the receptive-field halo of a patch edge see zero padding instead of their true neighbours, so the target is set
+    to nan there (and the nan-aware loss ignores them). Patch edges that coincide with the edge of the full grid are
+    exact and keep their targets.
+    """
+
+    def __init__(self, patch_size, halo, n_patches=1):
+        """
+        Parameters:
+        patch_size - int or tuple of ints, patch height and width (clipped to the grid size)
+        halo - int or tuple of ints, receptive-field halo along height and width (see receptive_field_halo)
+        n_patches - int, number of patches cropped from every sample
+        """
+        self.patch_size = (patch_size, patch_size) if isinstance(patch_size, int) else tuple(patch_size)
+        self.halo = (halo, halo) if isinstance(halo, int) else tuple(halo)
+        self.n_patches = n_patches
+        if any(p <= 2 * h for p, h in zip(self.patch_size, self.halo)):
+            raise ValueError("patch size must be larger than twice the halo to leave an interior")
+
+    def _offsets(self, n, size, patch, halo, device):
+        """
+        Draws patch offsets along one spatial axis and returns the (n, patch) indices and interior mask of each patch
+        """
+        start = torch.randint(0, size - patch + 1, (n,), device=device)
+        local = torch.arange(patch, device=device)
+        interior = ((local >= halo) | (start[:, None] == 0)) & \
+                   ((local < patch - halo) | (start[:, None] + patch == size))
+        return start[:, None] + local, interior
+
+    def __call__(self, x, y, threshes):
+        """
+        Parameters:
+        x - tensor, predictors (n, c, t, h, w)
+        y - tensor, target (n, 1, h, w)
+        threshes - tensor, thresholds (n, 1, h, w)
+
+        Returns:
+        x, y, threshes - tensors, the n * n_patches cropped patches. y is nan outside each patch's interior
+        """
+        h, w = y.shape[-2:]
+        ph, pw = min(self.patch_size[0], h), min(self.patch_size[1], w)
+        samples = torch.arange(y.shape[0], device=y.device).repeat_interleave(self.n_patches)
+        rows, row_interior = self._offsets(len(samples), h, ph, self.halo[0], y.device)
+        cols, col_interior = self._offsets(len(samples), w, pw, self.halo[1], y.device)
+
+        def crop(a):
+            # advanced indices around the ellipsis put the (n, ph, pw) patch dims first, so move them back
+            out = a[samples[:, None, None], ..., rows[:, :, None], cols[:, None, :]]
+            return torch.movedim(out, (1, 2), (-2, -1))
+
+        interior = row_interior[:, None, :, None] & col_interior[:, None, None, :]
+        y = crop(y)
+        y = torch.where(interior, y, torch.full_like(y, np.nan))
+        return crop(x), y, crop(threshes)
+
+
+class ThresholdSampler(nn.Module):
+    """
+    Draws random thresholds for training the variable threshold DEMM. For every sample and pixel a quantile level is
+    drawn uniformly from [lower, upper] and mapped to a threshold through that pixel's climatology (its sorted
+    training targets) with the same linear interpolation as np.quantile. Everything runs on the climatology's device
+    so a batch of fresh thresholds costs a couple of elementwise kernels and two gathers, with no precomputed file of
+    thresholds and no reuse of permuted samples.
+    """
+
+    def __init__(self, y, lower=0.5, upper=0.95, fill_value=0.):
+        """
+        Parameters:
+        y - array-like, training targets (n, ..., h, w)
+        lower - scalar, lowest quantile level
+        upper - scalar, highest quantile level
+        fill_value - scalar, threshold used at pixels whose targets are all nan
+        """
+        super().__init__()
+        y = torch.as_tensor(np.asarray(y), dtype=torch.float)
+        self.grid_shape = tuple(y.shape[1:])
+        y = y.reshape(len(y), -1)
+        # nans are sorted last so the first counts[i] entries of column i are its sorted valid targets
+        self.register_buffer("climatology", torch.sort(y, dim=0).values, persistent=False)
+        self.register_buffer("counts", (~torch.isnan(y)).sum(dim=0), persistent=False)
+        self.lower = lower
+        self.upper = upper
+        self.fill_value = fill_value
+
+    def forward(self, n):
+        """
+        Returns a (n, ..., h, w) tensor of random thresholds
+        """
+        last = (self.counts - 1).clamp(min=0)
+        q = self.lower + (self.upper - self.lower) * torch.rand(
+            (n, self.counts.numel()), device=self.climatology.device, dtype=self.climatology.dtype)
+        pos = q * last
+        lo = pos.floor().long()
+        hi = torch.minimum(lo + 1, last.expand_as(lo))
+        lo_vals, hi_vals = self.climatology.gather(0, lo), self.climatology.gather(0, hi)
+        threshes = lo_vals + (pos - lo) * (hi_vals - lo_vals)
+        threshes = torch.where(self.counts > 0, threshes, torch.full_like(threshes, self.fill_value))
+        return threshes.reshape((n,) + self.grid_shape)
+
+
 def get_device():
     """
     Determines whether to use cuda or cpu for tensors
@@ -37,15 +396,6 @@ def get_device():
     return device
 
 
-def set_default_tensor_type():
-    """
-    In my experience I run in to numerical issues w/ float
-    but I haven't experimented with the data type in a while
-    """
-    torch.set_default_tensor_type(torch.DoubleTensor)
-    return torch.double
-
-
 def gp_mean(xi, sigma, thresh, eps=1e-4):
     """
     Given xi, sigma, and a threshold it computes the mean of
@@ -54,7 +404,7 @@ def gp_mean(xi, sigma, thresh, eps=1e-4):
     return thresh + sigma / (1 - xi)
 
 
-def trunc_lognorm_mean(mu, var, upper, eps=1e-6):
+def trunc_lognorm_mean(mu, var, upper, log_norm=None):
     """
     Computes the mean of a truncated lognormal. Note that there's
     a couple different parameterizations of the lognormal distribution.
@@ -64,13 +414,15 @@ def trunc_lognorm_mean(mu, var, upper, eps=1e-6):
     mu - tensor, first lognormal parameter
     var - tensor, second lognormal parameter (variance)
     upper - tensor, threshold that defines right edge of distribution
+    log_norm - tensor or None, precomputed lognorm_logcdf(upper, mu, var) (see MixtureParams)
     """
-    beta = (torch.log(upper) - mu) / var ** 0.5
     sigma = var ** 0.5
-    scaling_factor = norm_cdf(beta - sigma, torch.zeros_like(beta), torch.ones_like(beta)) / (
-            eps + norm_cdf(beta, torch.zeros_like(beta), torch.ones_like(beta)))
-    exp = torch.exp(mu + var / 2)
-    return exp * scaling_factor
+    beta = (torch.log(upper) - mu) / sigma
+    if log_norm is None:
+        log_norm = torch.special.log_ndtr(beta)
+    # the ratio of normal cdfs is computed in log-space so it stays accurate when both are tiny
+    log_scaling_factor = torch.special.log_ndtr(beta - sigma) - log_norm
+    return torch.exp(mu + var / 2 + log_scaling_factor)
 
 
 def norm_cdf(vals, mu, sigma):
@@ -89,12 +441,9 @@ def torch_rmse(w_nans_l, w_nans_r):
     Computes RMSE between two tensors while ignoring nans while preserving gradients
     """
     w_nans_l, w_nans_r = w_nans_l.squeeze(), w_nans_r.squeeze()
-    denan_l = torch.zeros_like(w_nans_l, device=get_device())
-    denan_r = torch.zeros_like(w_nans_r, device=get_device())
     nonan_mask = ~torch.isnan(w_nans_l + w_nans_r)
-    denan_l[nonan_mask] += w_nans_l[nonan_mask]
-    denan_r[nonan_mask] += w_nans_r[nonan_mask]
-    return torch.sqrt(torch.mean(((denan_l - denan_r) ** 2)[nonan_mask]))
+    diff = torch.where(nonan_mask, w_nans_l - w_nans_r, torch.zeros_like(w_nans_l))
+    return torch.sqrt(torch.sum(diff ** 2) / torch.sum(nonan_mask))
 
 
 def lognorm_mean(mu, var):
@@ -110,7 +459,7 @@ def lognorm_mean(mu, var):
     return torch.exp(mu + var / 2)
 
 
-def all_mean(gpd_stats, moderate_stats, zero_probs, excess_probs, threshes, moderate_func):
+def all_mean(gpd_stats, moderate_stats, zero_probs, excess_probs, threshes, moderate_func, log_norm=None):
     """
     Computes the mean of the mixture model. By setting excess probs to 0 and threshes to 99999999 it ignores gpd component
     gpd_stats - tensor, statistics of gpd distribution: gpd_stats[:, 0] is xi and gpd_stats[:, 1] is sigma
@@ -118,20 +467,19 @@ def all_mean(gpd_stats, moderate_stats, zero_probs, excess_probs, threshes, mode
     zero_probs - tensor, probability of zero rainfall
     excess_probs - tensor, probability of excess rainfall given non-zero
     threshes - tensor, threshold defining excess vs non-excess value
+    log_norm - tensor or None, precomputed log of the lognormal cdf at the threshold (see MixtureParams)
     """
     weighted_zero = 0.  # weighted mean of zero rainfall component
     # Compute weighted mean of lognormal component of the model
     if moderate_func == 'lognormal':
-        weighted_moderate = trunc_lognorm_mean(moderate_stats[:, 0], moderate_stats[:, 1], threshes)
-        weighted_moderate *= (1 - zero_probs) * (1 - excess_probs)
+        weighted_moderate = trunc_lognorm_mean(moderate_stats[:, 0], moderate_stats[:, 1], threshes, log_norm)
+        weighted_moderate = weighted_moderate * (1 - zero_probs) * (1 - excess_probs)
     else:
         raise ValueError('only lognormal function is supported for mean calculations')
-    # Compute weighted mean of gpd component if we are using EVT
-    if torch.all(torch.isinf(threshes)):
-        weighted_excess = 0.  # we are not using EVT
-    else:
-        weighted_excess = gp_mean(gpd_stats[:, 0], gpd_stats[:, 1], threshes)
-        weighted_excess *= (1 - zero_probs) * excess_probs
+    # Compute weighted mean of gpd component wherever we are using EVT (i.e. the threshold is finite)
+    weighted_excess = gp_mean(gpd_stats[:, 0], gpd_stats[:, 1], threshes)
+    weighted_excess *= (1 - zero_probs) * excess_probs
+    weighted_excess = torch.where(torch.isinf(threshes), torch.zeros_like(weighted_excess), weighted_excess)
 
     # return weighted mean
     return weighted_zero + weighted_moderate + weighted_excess
@@ -309,19 +657,6 @@ def all_constraints(binaries, gpd_stats, main_stats, maxis, continuous_evt, main
     return binaries, gpd_stats, main_stats
 
 
-def to_tensor(a):
-    """
-    Converts a numpy array or scalar to a tensor
-    """
-    device = get_device()
-    if 'int' in str(type(a)) or 'float' in str(type(a)):
-        return torch.tensor(np.array([a]), device=device)
-    elif 'tuple' in str(type(a)):
-        return tuple(torch.tensor(np.array([x]), device=device) for x in a)
-    else:
-        return torch.tensor(a, device=device)
-
-
 def to_np(a):
     """
     Converts a tensor or list of tensor to a numpy array or list of numpy arrays respectively
@@ -346,52 +681,11 @@ def to_item(a):
         return a.item()
 
 
-def gpd(raw_samples, xi, sigma):
-    """
-    Computes log-likelihood of gpd distribution
-
-    Parameters:
-    raw_samples - tensor, excesses over threshold
-    xi - tensor, shape parameter
-    sigma - tensor, scale parameter
-
-    Returns:
-    out - tensor, log-likelihood of each excess value
-    """
-    samples = torch.zeros_like(raw_samples) + raw_samples  # Create dummy array to ensure gradients flow correctly
-    mask = ~torch.isnan(raw_samples)  # create a mask for non-nan samples
-    alt_mask = ~torch.isnan(xi)  # create a mask for non-nan shape values
-    mask = mask & alt_mask
-    samples[~mask] = 0
-    xi_is_zero = (xi == 0)
-    """
-    Case where xi != 0
-    """
-    xi_nz = torch.log(sigma[~xi_is_zero]) + (1 + 1 / xi[~xi_is_zero]) * mask[~xi_is_zero] * torch.log(
-        1 + xi[~xi_is_zero] * samples[~xi_is_zero] / sigma[~xi_is_zero])
-    # change from negative log-likelihood to log-likelihood
-    xi_nz *= -1.
-
-    """
-    Case where xi = 0
-    """
-    xi_z = torch.log(sigma[xi_is_zero]) + (1 / sigma[xi_is_zero]) * samples[xi_is_zero]
-    # change from negative log-likelihood to log-likelihood
-    xi_z *= -1
-
-    # Have to create a dummy tensor to ensure gradients are computed correctly
-    out = torch.zeros_like(samples)
-    out[xi_is_zero] += xi_z
-    out[~xi_is_zero] += xi_nz
-    out[~mask] = np.nan
-
-    return out
-
-
 def true_gpd(samps, xis, sigmas):
     """
     Computes gpd log likelihood w/ scipy. Strictly for debugging
     """
+    from scipy.stats import genpareto  # scipy is imported lazily to keep importing this module fast
     logliks = list()
     for i in range(samps.shape[0]):
         logliks.append(genpareto.logpdf(samps[i, :], xis[i], scale=sigmas[i]))
@@ -403,7 +697,7 @@ def torch_nanmean(vals):
     Torch version of np.nanmean
     """
     inds = ~torch.isnan(vals)
-    return torch.mean(vals[inds])
+    return torch.sum(torch.where(inds, vals, torch.zeros_like(vals))) / torch.sum(inds)
 
 
 def lognorm_cdf(vals, mu, var):
@@ -417,40 +711,38 @@ def lognorm_cdf(vals, mu, var):
     mu - tensor, mu parameter
     var - tensor, variance parameter
     """
-    return 0.5 + 0.5 * torch.erf((torch.log(vals) - mu) / (var ** 0.5 * math.sqrt(2)))
+    # Phi(x) = erfc(-x / sqrt(2)) / 2 keeps the lower tail accurate (torch's float32 ndtr loses it below about -5)
+    return 0.5 * torch.special.erfc((mu - torch.log(vals)) / (2 * var) ** 0.5)
 
 
-def lognormal(samples, mu, var):
+def lognorm_logcdf(vals, mu, var):
     """
-    Lognormal distribution log likelihood function. Note that there's
-    a couple different parameterizations of the lognormal distribution.
-    This code is based on the parameterization here:
-    https://en.wikipedia.org/wiki/Log-normal_distribution
+    Computes the log of the lognormal cdf (see lognorm_cdf). It is evaluated with log_ndtr so it stays accurate
+    in the lower tail where the cdf itself underflows.
     Parameters:
-    samples - tensor, samples
+    vals - tensor, samples
     mu - tensor, mu parameter
     var - tensor, variance parameter
     """
-    samples[samples == 0] += 10  # this is a janky way of avoiding nans. You can add any positive value here
-    # without affecting the computation.
-    first_term = -torch.log(samples) - 0.5 * torch.log(var) - 0.5 * torch.log(to_tensor(2 * 3.14159274))
-    second_term = -((torch.log(samples) - mu) ** 2 / (2 * var))
-    return first_term + second_term
+    return torch.special.log_ndtr((torch.log(vals) - mu) / var ** 0.5)
 
 
-def threshed_lognorm(samples, threshes, mu, var, eps=1e-6):
+def lognormal(samples, mu, var):
     """
-    Thresholded lognormal distribution log likelihood function. Note that there's
+    Lognormal distribution log likelihood function. Note that there's
     a couple different parameterizations of the lognormal distribution.
     This code is based on the parameterization here:
     https://en.wikipedia.org/wiki/Log-normal_distribution
     Parameters:
     samples - tensor, samples
-    threshes - tensor, upper threshold
     mu - tensor, mu parameter
     var - tensor, variance parameter
     """
-    return lognormal(samples, mu, var) - torch.log(lognorm_cdf(threshes, mu, var) + eps)
+    samples = torch.where(samples == 0, samples + 10, samples)  # this is a janky way of avoiding nans. You can add
+    # any positive value here without affecting the computation.
+    first_term = -torch.log(samples) - 0.5 * torch.log(var) - 0.5 * math.log(2 * math.pi)
+    second_term = -((torch.log(samples) - mu) ** 2 / (2 * var))
+    return first_term + second_term
 
 
 def threshed_lognorm_cdf(vals, mu, var, lower=None, upper=None):
@@ -468,27 +760,30 @@ def threshed_lognorm_cdf(vals, mu, var, lower=None, upper=None):
     """
     if upper is None:
         upper = 99999999.
-        upper_cdf = 1
+        upper_cdf = torch.ones_like(vals)
     else:
         upper_cdf = lognorm_cdf(upper, mu, var)
     if lower is None:
         lower = -99999999.
-        lower_cdf = 0.
+        lower_cdf = torch.zeros_like(vals)
     else:
         lower_cdf = lognorm_cdf(lower, mu, var)
     denom = upper_cdf - lower_cdf
     out = lognorm_cdf(vals, mu, var) / denom
-    out[vals < lower] = 0
-    out[vals > upper] = 1
-    out[denom == 0] = 0
-    return out
+    out = torch.where(vals < lower, torch.zeros_like(out), out)
+    out = torch.where(vals > upper, torch.ones_like(out), out)
+    return torch.where(denom == 0, torch.zeros_like(out), out)
 
 
 def gpd_cdf(vals, xi, sigma, thresh=0.):
     """
-    Computes cdf of GPD
+    Computes cdf of GPD. 1 - (1 + xi * z) ** (-1 / xi) is evaluated as -expm1(-log1p(xi * z) / xi) so it is
+    accurate for small excesses and small xi, and xi = 0 uses the exponential limit 1 - exp(-z)
     """
-    return 1 - (1 + xi * (vals - thresh) / sigma) ** (-1 / xi)
+    z = (vals - thresh) / sigma
+    xi_is_zero = xi == 0
+    safe_xi = torch.where(xi_is_zero, torch.ones_like(xi), xi)
+    return -torch.expm1(torch.where(xi_is_zero, -z, -torch.log1p(safe_xi * z) / safe_xi))
 
 
 def all_cdf(samples, gpd_stats, moderate_stats, zero_probs, excess_probs, effective_threshes, actual_threshes,
@@ -506,87 +801,164 @@ def all_cdf(samples, gpd_stats, moderate_stats, zero_probs, excess_probs, effect
     actual threshes - tensor, actual threshold which defines extreme values -- effectively ignored by Hurdle baseline
     moderate_func - string, determines which density function is used for non-extreme values. Must be 'lognormal'
     """
-    out = torch.zeros_like(samples)
+    zeros = torch.zeros_like(samples)
     nz_inds = samples > 0
     excess_inds = samples > effective_threshes
-    out[samples >= 0] += zero_probs[samples >= 0]
+    out = torch.where(samples >= 0, zero_probs, zeros)
     if moderate_func == 'lognormal':
-        out[nz_inds] += (1 - zero_probs[nz_inds]) * (1 - excess_probs[nz_inds]) * threshed_lognorm_cdf(samples[nz_inds],
-                                                                                                       moderate_stats[
-                                                                                                           nz_inds, 0],
-                                                                                                       moderate_stats[
-                                                                                                           nz_inds, 1],
-                                                                                                       upper=
-                                                                                                       effective_threshes[
-                                                                                                           nz_inds])
+        moderate_cdf = threshed_lognorm_cdf(samples, moderate_stats[:, 0], moderate_stats[:, 1],
+                                            upper=effective_threshes)
+        out = out + torch.where(nz_inds, (1 - zero_probs) * (1 - excess_probs) * moderate_cdf, zeros)
     else:
         raise ValueError('only lognormal function is supported for non-excess values')
-    out[excess_inds] += (1 - zero_probs[excess_inds]) * excess_probs[excess_inds] * gpd_cdf(samples[excess_inds],
-                                                                                            gpd_stats[excess_inds, 0],
-                                                                                            gpd_stats[excess_inds, 1],
-                                                                                            thresh=actual_threshes[
-                                                                                                excess_inds])
+    excess_cdf = gpd_cdf(samples, gpd_stats[:, 0], gpd_stats[:, 1], thresh=actual_threshes)
+    out = out + torch.where(excess_inds, (1 - zero_probs) * excess_probs * excess_cdf, zeros)
     return out
 
 
-def loglik_zero(samples, zero_probs):
-    """
-    Computes log-likelihood of the mixture model's first component which governs probability of 0 rainfall
-    Parameters:
-    samples - tensor, samples
-    zero_probs - tensor, predicted probability of zero rainfall
-    """
-    z_bool = is_zero(samples, False)  # binary tensor that's 1 if no rainfall
-    nz_bool = is_zero(samples, True)  # binary tensor that's 0 if no rainfall
-    out_zero = torch.zeros_like(samples) + z_bool * torch.log(zero_probs)  # log likelihood of 0 rainfall samples
-    out_nonzero = torch.zeros_like(samples) + nz_bool * (
-        torch.log(1 - zero_probs))  # log likelihood of nonzero rainfall samples
-    nan_inds = torch.isnan(samples)
-    out_zero[nan_inds] += np.nan
-    out_nonzero[nan_inds] += np.nan
-    return out_zero, out_nonzero
-
-
-def loglik_above_thresh(samples, threshes, above_thresh_probs):
+def all_sf(levels, bin_pred, gpd_pred, norm_pred, threshes, log_norm=None):
     """
-    Computes log-likelihood contributed by the boolean probability excess rainfall given non-zero rainfall
+    Computes exceedance probabilities P(y > level) of the mixture model (one minus all_cdf) for several levels at
+    once in one broadcasted pass. Levels below the threshold only need the lognormal cdf and levels above it only
+    the gpd survival function.
     Parameters:
-    samples - tensor, samples
-    threshes - tensor, thresholds defining transition from non-excess to excess
-    above_thresh_probs - tensor, predicted probability of excess rainfall given non-zero rainfall
-    """
-    t_bool = is_above_thresh(samples, threshes, False)  # binary tensor that's 1 if excess and non-zero
-    nt_bool = is_above_thresh(samples, threshes, True)  # binary tensor that's 1 if non-excess and non-zero
-    return t_bool * torch.log(above_thresh_probs), nt_bool * torch.log(1 - above_thresh_probs)
-
+    levels - array-like or tensor of shape (K,), (K, h, w) or (K,) + threshes.shape, levels shared by all pixels
+             or given per pixel. A per-pixel stack is aligned with the trailing dims of threshes
+    bin_pred - tensor, bin_pred[:, 0] is probability of 0 rainfall and bin_pred[:, 1] is probability of excess rainfall
+               given non-zero rainfall
+    gpd_pred - tensor, GPD parameters -- gpd_pred[:, 0] is xi and gpd_pred[:, 1] is sigma
+    norm_pred - tensor, lognormal parameters -- norm_pred[:, 0] is mu, norm_pred[:, 1] is variance
+    threshes - tensor, threshold between excess and non-excess. This is the effective threshold used by the model
+               (very large for the hurdle baseline which lacks EVT)
+    log_norm - tensor or None, precomputed log of the lognormal cdf at the threshold (see MixtureParams)
 
-def is_above_thresh(samples, threshes, flip):
-    """
-    Returns binary tensor that indicates if samples are excess or not
+    Returns:
+    out - tensor of shape (K,) + threshes.shape, the exceedance probabilities at every level
+    """
+    zero_probs, excess_probs = bin_pred[:, 0], bin_pred[:, 1]
+    xi, sigma = gpd_pred[:, 0], gpd_pred[:, 1]
+    mu, var = norm_pred[:, 0], norm_pred[:, 1]
+    if log_norm is None:
+        log_norm = lognorm_logcdf(threshes, mu, var)
+    levels = torch.as_tensor(levels, dtype=threshes.dtype, device=threshes.device)
+    levels = levels.reshape(levels.shape[:1] + (1,) * (threshes.dim() + 1 - levels.dim()) + levels.shape[1:])
+    ones = torch.ones_like(levels * threshes)
+    is_moderate = (levels > 0) & (levels <= threshes)
+    is_excess = levels > threshes
+
+    # Non-excess levels: the part of the truncated lognormal above the level is 1 - Phi(alpha) / Phi(beta). Above
+    # the median it is computed as (Phi(-alpha) - Phi(-beta)) / Phi(beta) so small exceedance probabilities keep
+    # their relative accuracy. The log of the levels is taken before broadcasting
+    sd = (2 * var) ** 0.5  # normal cdfs are evaluated as Phi(x) = erfc(-x / sqrt(2)) / 2, see lognorm_cdf
+    alpha = (torch.log(torch.where(levels > 0, levels, torch.ones_like(levels))) - mu) / sd
+    upper = alpha > 0
+    tail = 0.5 * torch.special.erfc(torch.where(upper, alpha, -alpha))
+    tiny = torch.finfo(tail.dtype).tiny
+    upper_sf = (tail - 0.5 * torch.special.erfc((torch.log(threshes) - mu) / sd)) / torch.exp(log_norm)
+    lower_sf = -torch.expm1(torch.log(tail.clamp(min=tiny)) - log_norm)
+    moderate_sf = torch.where(is_moderate, torch.where(upper, upper_sf.clamp(min=0), lower_sf), ones)
+
+    # Excess levels: survival function of the gpd, (1 + xi * z) ** (-1 / xi) or exp(-z) in the limit xi = 0
+    z = torch.where(is_excess, levels - threshes, 0 * ones) / sigma
+    xi_is_zero = xi == 0
+    safe_xi = torch.where(xi_is_zero, torch.ones_like(xi), xi)
+    in_support = safe_xi * z > -1
+    log_survival = torch.where(xi_is_zero, -z, -torch.log1p(torch.where(in_support, safe_xi * z, 0 * ones)) / safe_xi)
+    excess_sf = torch.where(in_support, torch.exp(log_survival), 0 * ones)
+
+    nonzero_sf = excess_probs + (1 - excess_probs) * moderate_sf
+    out = torch.where(is_excess, excess_probs * excess_sf, nonzero_sf) * (1 - zero_probs)
+    return torch.where(levels < 0, ones, out)
+
+
+def all_ppf(q, bin_pred, gpd_pred, norm_pred, threshes):
+    """
+    Computes quantiles of the mixture model (the inverse of all_cdf) in closed form for several quantile levels
+    at once. Levels up to the probability of zero rainfall map to 0, the next (1 - p0) * (1 - pe) of probability
+    mass to the lognormal truncated at the threshold and the rest to the gpd above the threshold. q = 1 gives the
+    upper end of the support, which is infinite unless xi < 0, so it should not be part of a loss.
     Parameters:
-    samples - tensor, samples
-    threshes - tensor, threshold between non-excess and excess
-    flip - if False excess values are 1 and everything else 0
-           if True non-zero non-excess values are 1 and everything else 0
-    """
-    if flip:
-        return (samples < threshes) & (samples > 0)
-    else:
-        return (samples >= threshes) & (samples > 0)
-
+    q - array-like or tensor of shape (K,) or (K,) + threshes.shape, quantile levels in [0, 1] shared by all
+        pixels or given per pixel
+    bin_pred - tensor, bin_pred[:, 0] is probability of 0 rainfall and bin_pred[:, 1] is probability of excess rainfall
+               given non-zero rainfall
+    gpd_pred - tensor, GPD parameters -- gpd_pred[:, 0] is xi and gpd_pred[:, 1] is sigma
+    norm_pred - tensor, lognormal parameters -- norm_pred[:, 0] is mu, norm_pred[:, 1] is variance
+    threshes - tensor, threshold between excess and non-excess. This is the effective threshold used by the model
+               (very large for the hurdle baseline which lacks EVT)
 
-def is_zero(samples, flip):
-    """
-    Returns binary tensor that indicates if samples are 0 or not
+    Returns:
+    out - tensor of shape (K,) + threshes.shape, the quantiles at every level
+    """
+    zero_probs, excess_probs = bin_pred[:, 0], bin_pred[:, 1]
+    xi, sigma = gpd_pred[:, 0], gpd_pred[:, 1]
+    mu, var = norm_pred[:, 0], norm_pred[:, 1]
+    q = torch.as_tensor(q, dtype=threshes.dtype, device=threshes.device)
+    if q.dim() <= 1:
+        q = q.reshape((-1,) + (1,) * threshes.dim())
+    ones = torch.ones_like(q * threshes)
+    moderate_mass = (1 - zero_probs) * (1 - excess_probs)
+    excess_mass = (1 - zero_probs) * excess_probs
+    is_zero = q <= zero_probs
+    is_excess = q > zero_probs + moderate_mass
+    is_moderate = ~is_zero & ~is_excess
+    # Each branch is evaluated with dummy levels where it is not selected so no nans reach the gradients
+
+    # Non-zero non-excess values: invert the lognormal truncated at the threshold. With u the level within this
+    # branch the normal quantile is ndtri(u * Phi(beta)). Near the top of the branch it is computed from the upper
+    # tail 1 - u * Phi(beta) = (1 - u) + u * Phi(-beta) instead, which does not round to 1
+    safe_moderate_mass = torch.where(is_moderate, moderate_mass, ones)
+    u = torch.where(is_moderate, (q - zero_probs) / safe_moderate_mass, 0.5 * ones)
+    u_complement = torch.where(is_moderate, (zero_probs + moderate_mass - q) / safe_moderate_mass, 0.5 * ones)
+    sd = var ** 0.5
+    beta = (torch.log(threshes) - mu) / sd
+    lower_tail = torch.exp(torch.log(u) + torch.special.log_ndtr(beta))
+    upper_tail = u_complement + u * torch.special.ndtr(-beta)
+    z = torch.where(lower_tail < 0.5, torch.special.ndtri(lower_tail.clamp(max=0.5)),
+                    -torch.special.ndtri(upper_tail.clamp(max=0.5)))
+    moderate_q = torch.exp(mu + sd * torch.minimum(z, beta))
+
+    # Excess values: invert the gpd above the threshold, using the exponential limit where xi = 0. The log survival
+    # probability within this branch is computed from v or from 1 - v, whichever is smaller
+    safe_excess_mass = torch.where(is_excess, excess_mass, ones)
+    v = torch.where(is_excess, (q - zero_probs - moderate_mass) / safe_excess_mass, 0.5 * ones)
+    v_complement = torch.where(is_excess, (1 - q) / safe_excess_mass, 0.5 * ones)
+    log_survival = torch.where(v < 0.5, torch.log1p(-v.clamp(max=0.5)), torch.log(v_complement))
+    xi_is_zero = xi == 0
+    safe_xi = torch.where(xi_is_zero, torch.ones_like(xi), xi)
+    excess_q = threshes + sigma * torch.where(xi_is_zero, -log_survival, torch.expm1(-safe_xi * log_survival) / safe_xi)
+
+    return torch.where(is_zero, torch.zeros_like(ones), torch.where(is_excess, excess_q, moderate_q))
+
+
+@torch.no_grad()
+def sample_mixture(bin_pred, gpd_pred, norm_pred, threshes, n_samples, chunk_size=100, seed=None):
+    """
+    Draws random scenarios from the mixture model by inverse transform sampling, i.e. all_ppf of uniform random
+    levels drawn independently for every pixel. Draws are generated chunk_size scenarios at a time so memory stays
+    bounded however many scenarios are requested.
     Parameters:
-    samples - tensor, samples
-    flip - if False all 0 sample values return 1 and everything else 0
-           if True all non-zero samples return 1 and everything else 0
-    """
-    if flip:
-        return (samples != 0) & (~torch.isnan(samples))
+    bin_pred - tensor, bin_pred[:, 0] is probability of 0 rainfall and bin_pred[:, 1] is probability of excess rainfall
+               given non-zero rainfall
+    gpd_pred - tensor, GPD parameters -- gpd_pred[:, 0] is xi and gpd_pred[:, 1] is sigma
+    norm_pred - tensor, lognormal parameters -- norm_pred[:, 0] is mu, norm_pred[:, 1] is variance
+    threshes - tensor, effective threshold between excess and non-excess (see all_ppf)
+    n_samples - int, number of scenarios
+    chunk_size - int, number of scenarios generated at once
+    seed - int or None, seed of the random number generator. The same seed and chunk_size give the same scenarios
+
+    Yields:
+    scenarios - tensor of shape (m,) + threshes.shape with m <= chunk_size, the next m scenarios
+    """
+    generator = torch.Generator(device=threshes.device)
+    if seed is None:
+        generator.seed()
     else:
-        return (samples == 0)
+        generator.manual_seed(seed)
+    for start in range(0, n_samples, chunk_size):
+        levels = torch.rand((min(chunk_size, n_samples - start),) + tuple(threshes.shape), generator=generator,
+                            dtype=threshes.dtype, device=threshes.device)
+        yield all_ppf(levels, bin_pred, gpd_pred, norm_pred, threshes)
 
 
 def nan_to_num(x, fill_val=0.):
@@ -597,19 +969,127 @@ def nan_to_num(x, fill_val=0.):
     return x
 
 
-def nan_transfer(w_nan, wo_nan):
+def _masked_log(mask, x):
     """
-    Ensures that any indices where there's a nan in w_nan have a nan in wo_nan too.
+    Returns log(x) where mask is True and 0 elsewhere. Masked-out entries are replaced by 1 before the log so
+    that neither the value nor its gradient can become nan or inf there
     """
-    out = torch.zeros_like(wo_nan)
-    out += wo_nan
-    out[torch.isnan(w_nan)] += np.nan
-    return out
+    return torch.where(mask, torch.log(torch.where(mask, x, torch.ones_like(x))), torch.zeros_like(x))
 
 
-def loglik(samples, gpd_stats, moderate_stats, zero_probs, excess_probs, threshes, moderate_func):
+def _mixture_loglik(samples, xi, sigma, mu, var, zero_probs, excess_probs, threshes, log_norm=None):
+    """
+    Computes log-likelihood of mixture model in a single masked elementwise pass. Each sample only contributes
+    the terms of the components it falls into: zero (log p0), non-zero non-excess (log(1 - p0) + log(1 - pe) +
+    truncated lognormal) or excess (log(1 - p0) + log pe + gpd). Terms which evaluate to nan are dropped and nan
+    samples produce nan log-likelihoods. See loglik for the parameters.
     """
-    Computes log-likelihood of mixture model
+    if log_norm is None:
+        log_norm = lognorm_logcdf(threshes, mu, var)
+    zeros, ones = torch.zeros_like(samples), torch.ones_like(samples)
+
+    nan_inds = torch.isnan(samples)  # remember which samples are nan
+    y = torch.where(nan_inds, zeros, samples)
+    nonzero = y > 0
+    excess = y > threshes  # excesses are strictly above the threshold...
+    moderate = nonzero & ~excess
+    above = nonzero & (y >= threshes)  # ...but the excess probability covers samples equal to the threshold too
+
+    # Bernoulli components for zero and excess rainfall
+    total_loglik = _masked_log((y == 0) & ~nan_inds, zero_probs) + \
+        _masked_log((y != 0) & ~nan_inds, 1 - zero_probs) + \
+        _masked_log(above, excess_probs) + \
+        _masked_log(nonzero & (y < threshes), 1 - excess_probs)
+
+    # Log-likelihood contributed by excess values. Excesses outside of the gpd's support are dropped
+    excesses = torch.where(excess, y - threshes, zeros)
+    xi_is_zero = xi == 0
+    safe_xi = torch.where(xi_is_zero, ones, xi)
+    z = safe_xi * excesses / sigma
+    in_support = z > -1
+    xi_nz = (1 + 1 / safe_xi) * torch.log1p(torch.where(in_support, z, zeros))
+    excess_loglik = -(torch.log(sigma) + torch.where(xi_is_zero, excesses / sigma, xi_nz))
+    total_loglik = total_loglik + torch.where(excess & in_support & ~torch.isnan(excess_loglik), excess_loglik, zeros)
+
+    # Log-likelihood contributed by non-zero non-excess values under the lognormal truncated at the threshold
+    log_y = torch.log(torch.where(moderate, y, ones))
+    main_loglik = -log_y - 0.5 * torch.log(var) - 0.5 * math.log(2 * math.pi) - (log_y - mu) ** 2 / (2 * var) \
+        - log_norm
+    total_loglik = total_loglik + torch.where(moderate & ~torch.isnan(main_loglik), main_loglik, zeros)
+
+    return torch.where(nan_inds, torch.full_like(total_loglik, np.nan), total_loglik)
+
+
+class MixtureLoglik(torch.autograd.Function):
+    """
+    Log-likelihood of the mixture model with closed-form gradients. The forward pass is _mixture_loglik but only
+    its inputs are saved for the backward pass, which recomputes the component masks and evaluates the derivatives
+    with respect to xi, sigma, mu, var, zero_probs and excess_probs directly instead of backpropagating through
+    every intermediate. Samples and thresholds receive no gradient. The optional precomputed log normalizer of the
+    truncated lognormal receives none either, its contribution is part of the gradients of mu and var.
+    """
+
+    @staticmethod
+    def forward(ctx, samples, xi, sigma, mu, var, zero_probs, excess_probs, threshes, log_norm=None):
+        if log_norm is None:
+            log_norm = lognorm_logcdf(threshes, mu, var)
+        ctx.save_for_backward(samples, xi, sigma, mu, var, zero_probs, excess_probs, threshes, log_norm)
+        return _mixture_loglik(samples, xi, sigma, mu, var, zero_probs, excess_probs, threshes, log_norm)
+
+    @staticmethod
+    def backward(ctx, grad):
+        samples, xi, sigma, mu, var, zero_probs, excess_probs, threshes, log_cdf = ctx.saved_tensors
+        zeros, ones = torch.zeros_like(samples), torch.ones_like(samples)
+        nan_inds = torch.isnan(samples)
+        y = torch.where(nan_inds, zeros, samples)
+        nonzero = y > 0
+        excess = y > threshes
+        moderate = nonzero & ~excess
+
+        # Bernoulli components: d/dp log(p) = 1 / p and d/dp log(1 - p) = -1 / (1 - p)
+        grad_zero = torch.where((y == 0) & ~nan_inds, grad / zero_probs, zeros) - \
+            torch.where((y != 0) & ~nan_inds, grad / (1 - zero_probs), zeros)
+        grad_excess = torch.where(nonzero & (y >= threshes), grad / excess_probs, zeros) - \
+            torch.where(nonzero & (y < threshes), grad / (1 - excess_probs), zeros)
+
+        # gpd component: with u = e / sigma and z = xi * u the log-likelihood is
+        # -log(sigma) - (1 + 1 / xi) * log(1 + z), or -log(sigma) - u in the limit xi = 0
+        u = torch.where(excess, y - threshes, zeros) / sigma
+        xi_is_zero = xi == 0
+        safe_xi = torch.where(xi_is_zero, ones, xi)
+        z = safe_xi * u
+        in_support = z > -1
+        z = torch.where(in_support, z, zeros)
+        log1p_z = torch.log1p(z)
+        excess_loglik = -(torch.log(sigma) + torch.where(xi_is_zero, u, (1 + 1 / safe_xi) * log1p_z))
+        d_xi = torch.where(xi_is_zero, u ** 2 / 2 - u, log1p_z / safe_xi ** 2 - (1 + 1 / safe_xi) * u / (1 + z))
+        d_sigma = (torch.where(xi_is_zero, u, (1 + safe_xi) * u / (1 + z)) - 1) / sigma
+        excess = excess & in_support & ~torch.isnan(excess_loglik)
+        grad_xi = torch.where(excess, grad * d_xi, zeros)
+        grad_sigma = torch.where(excess, grad * d_sigma, zeros)
+
+        # truncated lognormal component: with r = log(y) - mu and beta = (log(threshes) - mu) / sqrt(var) the
+        # log-likelihood is -log(y) - log(var) / 2 - log(2 pi) / 2 - r^2 / (2 var) - log(Phi(beta))
+        r = torch.log(torch.where(moderate, y, ones)) - mu
+        sd = var ** 0.5
+        beta = (torch.log(threshes) - mu) / sd
+        pdf_over_cdf = torch.exp(-beta ** 2 / 2 - 0.5 * math.log(2 * math.pi) - log_cdf)  # stable for beta << 0
+        main_loglik = -r - mu - 0.5 * torch.log(var) - 0.5 * math.log(2 * math.pi) - r ** 2 / (2 * var) - log_cdf
+        d_mu = r / var + pdf_over_cdf / sd
+        d_var = (r ** 2 / var - 1 + pdf_over_cdf * beta) / (2 * var)
+        moderate = moderate & ~torch.isnan(main_loglik)
+        grad_mu = torch.where(moderate, grad * d_mu, zeros)
+        grad_var = torch.where(moderate, grad * d_var, zeros)
+
+        return None, grad_xi.sum_to_size(xi.shape), grad_sigma.sum_to_size(sigma.shape), \
+            grad_mu.sum_to_size(mu.shape), grad_var.sum_to_size(var.shape), \
+            grad_zero.sum_to_size(zero_probs.shape), grad_excess.sum_to_size(excess_probs.shape), None, None
+
+
+def loglik(samples, gpd_stats, moderate_stats, zero_probs, excess_probs, threshes, moderate_func, log_norm=None):
+    """
+    Computes log-likelihood of mixture model (see _mixture_loglik). Gradients are computed in closed form by
+    MixtureLoglik so backpropagating does not keep the intermediates of every mixture component alive.
     Parameters:
     samples - tensor, samples
     gpd_stats - tensor, gpd statistics (gpd_stats[:, 0] is xi, gpd_stats[:, 1] is sigma)
@@ -618,74 +1098,254 @@ def loglik(samples, gpd_stats, moderate_stats, zero_probs, excess_probs, threshe
     excess_probs - tensor, probability of excess rainfall given non-zero
     threshes - tensor, threshold between excess and non-excess
     moderate_func - string, determines density function governing non-excess values. Must be 'lognormal'
+    log_norm - tensor or None, precomputed log of the lognormal cdf at the threshold (see MixtureParams)
     """
-    nan_inds = torch.isnan(samples)  # remember which samples are nan
-    zero_loglik, nz_loglik = loglik_zero(samples, zero_probs)
-    thresh_loglik, nthresh_loglik = loglik_above_thresh(samples, threshes, excess_probs)
-
-    # Create tensor w/ just the excesses and all other entries nan
-    excesses = torch.zeros_like(samples)
-    excess_inds = samples > threshes
-    excesses[excess_inds] += samples[excess_inds] - threshes[excess_inds]
-    excesses[~excess_inds] /= 0
-    # Compute log-likelihood contributed by excess values
-    excess_loglik = gpd(excesses, gpd_stats[:, 0], gpd_stats[:, 1])
-
-    # Create tensor w/ just the non-zero non-excess values
-    nonzeros = torch.zeros_like(samples)
-    nz_inds = (samples > 0) & ~(excess_inds)
-    nonzeros[nz_inds] += samples[nz_inds]
-    if moderate_func == 'lognormal':
-        # Compute log-likelihood contributed by non-zero non-excess values
-        main_loglik = threshed_lognorm(nonzeros, threshes,
-                                       moderate_stats[:, 0],
-                                       moderate_stats[:, 1])
-    else:
+    if moderate_func != 'lognormal':
         raise ValueError('only lognormal is supported for non-excess values')
-    main_loglik[~nz_inds] = torch.zeros_like(main_loglik[~nz_inds]) / 0.  # Set all 0 values and excess values to nan
+    return MixtureLoglik.apply(samples, gpd_stats[:, 0], gpd_stats[:, 1], moderate_stats[:, 0], moderate_stats[:, 1],
+                               zero_probs, excess_probs, threshes, log_norm)
+
 
-    zero_loglik, nz_loglik, nthresh_loglik, main_loglik, thresh_loglik, excess_loglik = \
-        nan_transfer(samples, zero_loglik), \
-        nan_transfer(samples, nz_loglik), \
-        nan_transfer(samples, nthresh_loglik), \
-        nan_transfer(samples, main_loglik), \
-        nan_transfer(samples, thresh_loglik), \
-        nan_transfer(samples, excess_loglik)  # Make sure nans are propogating correctly
-    total_loglik = \
-        nan_to_num(zero_loglik) + \
-        nan_to_num(nz_loglik) + \
-        nan_to_num(nthresh_loglik) + \
-        nan_to_num(main_loglik) + \
-        nan_to_num(thresh_loglik) + \
-        nan_to_num(excess_loglik)  # Add up all log-likelihoods
-    total_loglik[nan_inds] += np.nan  # Make sure nans are propogating correctly
-    return total_loglik
+# Gauss-Legendre nodes and weights on [-1, 1] used by _trunc_normal_mean_cdf
+_CRPS_QUADRATURE = np.polynomial.legendre.leggauss(16)
 
 
-def split_var(x):
+def _trunc_normal_mean_cdf(c, s, log_norm):
     """
-    Weird little function that I'm pretty sure I needed
-    to make for debugging purposes. Keeping it just in case
+    Computes log(E[Phi(V + s) | V <= c] / Phi(c + s)) for a standard normal V with Gauss-Legendre quadrature over
+    the quantiles p = u^2 of V given V <= c (the substitution removes the integrand's singularity at p = 0). This is
+    the one term of the truncated lognormal's crps without a closed form in elementary functions (it is a
+    bivariate normal cdf).
+    Parameters:
+    c - tensor, truncation point of V
+    s - tensor, shift
+    log_norm - tensor, log(Phi(c + s))
+    """
+    nodes, weights = _CRPS_QUADRATURE
+    shape = (len(nodes),) + (1,) * c.dim()
+    u = (nodes + 1) / 2
+    p = torch.as_tensor(u ** 2, dtype=c.dtype, device=c.device).reshape(shape)
+    log_w = torch.as_tensor(np.log(weights * u), dtype=c.dtype, device=c.device).reshape(shape)
+    # quantiles of V given V <= c. Once Phi(c) underflows the exponential (Mills ratio) approximation of the
+    # normal's lower tail is used instead
+    log_level = torch.log(p) + torch.special.log_ndtr(c)
+    tiny = math.log(torch.finfo(c.dtype).tiny)
+    exact = log_level > tiny
+    v = torch.where(exact, torch.special.ndtri(torch.exp(log_level.clamp(min=tiny))),
+                    c - torch.log(p) / torch.where(exact, -torch.ones_like(c), c))
+    return torch.logsumexp(log_w + torch.special.log_ndtr(v + s), dim=0) - log_norm
+
+
+def _mixture_crps(samples, xi, sigma, mu, var, zero_probs, excess_probs, threshes, log_norm):
+    """
+    Computes the crps of the mixture model with the kernel form E|X - y| - E|X - X'| / 2 in closed form. For a
+    mixture both expectations split into expectations of its components: the point mass at zero (A), the lognormal
+    truncated at the threshold (B) and the gpd above the threshold (C). As B <= threshold <= C the cross terms only
+    need the component means. See crps for the parameters.
+    """
+    zeros, ones = torch.zeros_like(samples), torch.ones_like(samples)
+    y = torch.where(torch.isnan(samples), zeros, samples)
+    w_zero = zero_probs
+    w_moderate = (1 - zero_probs) * (1 - excess_probs)
+    w_excess = (1 - zero_probs) * excess_probs
+
+    # truncated lognormal: E[B 1{B <= c}] = exp(mu + var / 2) Phi((log(c) - mu) / sd - sd) / Phi(beta)
+    sd = var ** 0.5
+    beta = (torch.log(threshes) - mu) / sd
+    log_mean_scale = mu + var / 2 - log_norm
+    mean_moderate = torch.exp(log_mean_scale + torch.special.log_ndtr(beta - sd))
+    nonzero = y > 0
+    alpha = torch.minimum((torch.log(torch.where(nonzero, y, ones)) - mu) / sd, beta)
+    cdf_moderate = torch.where(nonzero, torch.exp(torch.special.log_ndtr(alpha) - log_norm), zeros)
+    partial_moderate = torch.where(nonzero, torch.exp(log_mean_scale + torch.special.log_ndtr(alpha - sd)), zeros)
+    abs_moderate = y * (2 * cdf_moderate - 1) + mean_moderate - 2 * partial_moderate
+    # E|B - B'| = 4 E[B F(B)] - 2 E[B]
+    log_expected_cdf = _trunc_normal_mean_cdf(beta - sd, sd, log_norm)
+    spread_moderate = 4 * mean_moderate * torch.exp(log_expected_cdf) - 2 * mean_moderate
+
+    # gpd: with z = (y - threshold) / sigma and survival function S, E|C - y| / sigma is
+    # z+ + (2 S(z+)^(1 - xi) - 1) / (1 - xi) + (z+ - z), and E|C - C'| / sigma = 2 / ((1 - xi) (2 - xi))
+    z = (y - threshes) / sigma
+    z_pos = torch.clamp(z, min=0)
+    xi_is_zero = xi == 0
+    safe_xi = torch.where(xi_is_zero, ones, xi)
+    in_support = safe_xi * z_pos > -1
+    log_survival = torch.where(xi_is_zero, -z_pos,
+                               -torch.log1p(torch.where(in_support, safe_xi * z_pos, zeros)) / safe_xi)
+    survival_pow = torch.where(in_support, torch.exp((1 - xi) * log_survival), zeros)
+    mean_excess = threshes + sigma / (1 - xi)
+    abs_excess = sigma * (2 * z_pos - z + (2 * survival_pow - 1) / (1 - xi))
+    spread_excess = 2 * sigma / ((1 - xi) * (2 - xi))
+
+    expected_abs = w_zero * y + w_moderate * abs_moderate + w_excess * abs_excess
+    expected_spread = 2 * w_zero * w_moderate * mean_moderate + 2 * w_zero * w_excess * mean_excess + \
+        2 * w_moderate * w_excess * (mean_excess - mean_moderate) + w_moderate ** 2 * spread_moderate + \
+        w_excess ** 2 * spread_excess
+    crps_ = expected_abs - expected_spread / 2
+    return torch.where(torch.isnan(samples), torch.full_like(crps_, np.nan), crps_)
+
+
+def crps(samples, gpd_stats, moderate_stats, zero_probs, excess_probs, threshes, moderate_func, log_norm=None):
+    """
+    Computes the continuous ranked probability score of the mixture model elementwise (see _mixture_crps). It is
+    exact except for one bivariate normal term of the truncated lognormal which uses a fixed 16 point quadrature,
+    so it is differentiable and much cheaper than estimating the crps from samples. Lower is better and nan
+    samples give nan scores.
+    Parameters:
+    samples - tensor, samples
+    gpd_stats - tensor, gpd statistics (gpd_stats[:, 0] is xi, gpd_stats[:, 1] is sigma). xi must be < 1
+    moderate_stats - tensor, lognormal statistics (moderate_stats[:, 0] is mu, moderate_stats[:, 1] is variance)
+    zero_probs - tensor, probability of zero rainfall
+    excess_probs - tensor, probability of excess rainfall given non-zero
+    threshes - tensor, threshold between excess and non-excess
+    moderate_func - string, determines density function governing non-excess values. Must be 'lognormal'
+    log_norm - tensor or None, precomputed log of the lognormal cdf at the threshold (see MixtureParams)
     """
-    splitted_var = torch.zeros_like(x, device=x.device)
-    return x + splitted_var
+    if moderate_func != 'lognormal':
+        raise ValueError('only lognormal is supported for non-excess values')
+    mu, var = moderate_stats[:, 0], moderate_stats[:, 1]
+    if log_norm is None:
+        log_norm = lognorm_logcdf(threshes, mu, var)
+    return _mixture_crps(samples, gpd_stats[:, 0], gpd_stats[:, 1], mu, var, zero_probs, excess_probs, threshes,
+                         log_norm)
+
+
+class MixtureParams:
+    """
+    Constrained mixture model parameters and thresholds of one batch. The terms shared by the log-likelihood, the
+    point prediction and the class probabilities are computed on first use and memoized, so evaluating a loss and
+    the metrics of a batch computes the lognormal cdf at the threshold once instead of once per function.
+    Iterating over it yields bin_pred, gpd_pred and norm_pred, so it can be used wherever a list of mixture model
+    parameters is expected.
+    """
+
+    def __init__(self, bin_pred, gpd_pred, norm_pred, threshes, actual_threshes=None, moderate_func='lognormal'):
+        """
+        Parameters:
+        bin_pred - tensor, bin_pred[:, 0] is probability of 0 rainfall and bin_pred[:, 1] is probability of excess
+                   rainfall given non-zero rainfall
+        gpd_pred - tensor, GPD parameters -- gpd_pred[:, 0] is xi and gpd_pred[:, 1] is sigma
+        norm_pred - tensor, lognormal parameters -- norm_pred[:, 0] is mu, norm_pred[:, 1] is variance
+        threshes - tensor, threshold used internally by the mixture model (the effective threshold)
+        actual_threshes - tensor or None, threshold defining the excess class of the class probabilities. Defaults
+                          to threshes
+        moderate_func - string, density function governing non-excess values. Must be 'lognormal'
+        """
+        if moderate_func != 'lognormal':
+            raise ValueError('only lognormal is supported for non-excess values')
+        self.bin_pred, self.gpd_pred, self.norm_pred = bin_pred, gpd_pred, norm_pred
+        self.threshes = threshes
+        self.actual_threshes = threshes if actual_threshes is None else actual_threshes
+        self.moderate_func = moderate_func
+        # memoized terms, computed on first access. Plain attributes rather than functools.cached_property so the
+        # object can be created and used inside torch.compile'd code
+        self._log_norm = None
+        self._point_pred = None
+        self._class_probs = None
+
+    def __iter__(self):
+        return iter((self.bin_pred, self.gpd_pred, self.norm_pred))
+
+    @property
+    def log_norm(self):
+        """
+        Log of the lognormal cdf at the threshold, the log normalizer of the truncated lognormal
+        """
+        if self._log_norm is None:
+            self._log_norm = lognorm_logcdf(self.threshes, self.norm_pred[:, 0], self.norm_pred[:, 1])
+        return self._log_norm
+
+    @property
+    def point_pred(self):
+        """
+        Mean of the mixture model (see all_mean)
+        """
+        if self._point_pred is None:
+            self._point_pred = all_mean(self.gpd_pred, self.norm_pred, self.bin_pred[:, 0], self.bin_pred[:, 1],
+                                        self.threshes, self.moderate_func, self.log_norm)
+        return self._point_pred
+
+    @property
+    def class_probs(self):
+        """
+        Probabilities of zero, non-zero non-excess and excess rainfall, where excesses are values above
+        actual_threshes (this equals 1 - all_cdf at actual_threshes)
+        """
+        if self._class_probs is None:
+            self._class_probs = self._compute_class_probs()
+        return self._class_probs
+
+    def _compute_class_probs(self):
+        zero_probs, excess_probs = self.bin_pred[:, 0], self.bin_pred[:, 1]
+        # fraction of the truncated lognormal below the actual threshold, 1 unless it is below the effective one
+        if self.actual_threshes is self.threshes:
+            below = 1.
+        else:
+            log_below = lognorm_logcdf(self.actual_threshes, self.norm_pred[:, 0], self.norm_pred[:, 1]) - self.log_norm
+            below = torch.where(self.actual_threshes >= self.threshes, torch.ones_like(log_below),
+                                torch.exp(torch.clamp(log_below, max=0)))
+        excess_class = 1 - zero_probs - (1 - zero_probs) * (1 - excess_probs) * below
+        return zero_probs, 1 - zero_probs - excess_class, excess_class
+
+    def loglik(self, samples):
+        """
+        Computes log-likelihood of samples (see loglik)
+        Parameters:
+        samples - tensor, samples
+        """
+        return loglik(samples, self.gpd_pred, self.norm_pred, self.bin_pred[:, 0], self.bin_pred[:, 1], self.threshes,
+                      self.moderate_func, self.log_norm)
+
+    def exceedance(self, levels):
+        """
+        Computes the probabilities of exceeding several levels in one pass (see all_sf)
+        Parameters:
+        levels - array-like or tensor of shape (K,), (K, h, w) or (K,) + threshes.shape, levels
+        """
+        return all_sf(levels, self.bin_pred, self.gpd_pred, self.norm_pred, self.threshes, self.log_norm)
+
+    def crps(self, samples):
+        """
+        Computes the crps of samples (see crps)
+        Parameters:
+        samples - tensor, samples
+        """
+        return crps(samples, self.gpd_pred, self.norm_pred, self.bin_pred[:, 0], self.bin_pred[:, 1], self.threshes,
+                    self.moderate_func, self.log_norm)
+
+
+def gather_valid(a, valid_index):
+    """
+    Flattens the last two (spatial) dims of a tensor and keeps only the cells in valid_index, giving a dense
+    (..., n_valid) tensor without the cells that are nan in every sample (see compute_valid_index in data.py)
+    """
+    return a.flatten(-2).index_select(-1, valid_index)
+
+
+# class label of samples whose target (or predicted probabilities) is nan
+MISSING_LABEL = -1
 
 
 def compute_class_labels(y, threshes):
     """
-    Creates an array of class labels for the target.
+    Creates an int8 tensor of class labels for the target, on the device of y.
     0 means the sample is 0
     1 means the sample is non-zero non-excess
     2 means the sample is excess
+    MISSING_LABEL means the sample is nan
+    """
+    y, threshes = torch.as_tensor(y), torch.as_tensor(threshes)
+    labels = torch.where(y == 0., 0, torch.where(y > threshes, 2, 1))
+    return torch.where(torch.isnan(y), MISSING_LABEL, labels).to(torch.int8)
+
+
+def compute_predicted_labels(probs):
     """
-    y, threshes = to_np(y), to_np(threshes)
-    labels = np.ones_like(y)
-    nans = np.isnan(y)
-    y[nans] = 0
-    labels[y == 0.] = 0
-    labels[y > threshes] = 2
-    labels[nans] = np.nan
-    return labels
+    Creates an int8 tensor of predicted class labels (the most probable class) from the stacked class probabilities,
+    samples with nan probabilities get MISSING_LABEL
+    """
+    labels = torch.argmax(torch.nan_to_num(probs, nan=0.), dim=0)
+    return torch.where(torch.isnan(probs).any(0), MISSING_LABEL, labels).to(torch.int8)
 
 
 def no_nans(a, b):
@@ -700,50 +1360,303 @@ def pearsonr(a, b):
     """
     Computes pearson correlation between two tensors
     """
+    from scipy.stats import pearsonr as scipy_pearsonr
     a, b = to_np(a), to_np(b)
     mask = no_nans(a, b)
-    return pearsonr(a.flatten(), b.flatten())[0]
+    return scipy_pearsonr(a.flatten(), b.flatten())[0]
 
 
 def accuracy(a, b):
     """
-    Computes portion of non-nan values where a and b match
+    Computes portion of non-missing labels where a and b match
     """
-    a, b = to_np(a), to_np(b)
-    nonan_mask = no_nans(a, b)
-    return np.mean((a == b)[nonan_mask])
+    valid = (a != MISSING_LABEL) & (b != MISSING_LABEL)
+    return torch.sum((a == b) & valid, dtype=torch.float64) / valid.sum()
+
+
+def confusion_matrix(tru, pred, n_classes=3):
+    """
+    Counts the samples of every true class (rows) predicted as every class (columns), ignoring missing labels. The
+    counts are accumulated with index_add_ so nothing is synchronized with the host
+    """
+    valid = ((tru != MISSING_LABEL) & (pred != MISSING_LABEL)).flatten()
+    index = torch.where(valid, n_classes * tru.flatten().long() + pred.flatten().long(), 0)
+    confusion = torch.zeros(n_classes * n_classes, dtype=torch.long, device=index.device)
+    return confusion.index_add_(0, index, valid.long()).view(n_classes, n_classes)
+
+
+def confusion_f1(confusion):
+    """
+    Computes f1 micro and macro from a confusion matrix, the macro average runs over the classes occurring in the
+    true or predicted labels like sklearn's f1_score
+    """
+    confusion = confusion.to(torch.float64)
+    tp = confusion.diagonal()
+    support, predicted = confusion.sum(1), confusion.sum(0)
+    micro = tp.sum() / confusion.sum()    # every sample has exactly one true and one predicted class
+    macro = torch.nanmean(2 * tp / (support + predicted))    # absent classes are 0 / 0
+    return micro, macro
 
 
 def f1(tru, pred):
     """
     Computes f1 micro and macro
     """
-    tru, pred = to_np(tru), to_np(pred)
-    nonan_mask = no_nans(tru, pred)
-    micro = f1_score(tru[nonan_mask].flatten(), pred[nonan_mask].flatten(), average='micro')
-    macro = f1_score(tru[nonan_mask].flatten(), pred[nonan_mask].flatten(), average='macro')
-    return micro, macro
+    return confusion_f1(confusion_matrix(tru, pred))
 
 
-def auc(tru_labels, pred_probs):
+def histogram_auc(pos, neg):
+    """
+    Computes the area under the ROC curve from histograms of the scores of positive and negative samples over the
+    same bins (scores within a bin count as ties)
     """
-    Computes one versus one and one versus rest auc
+    neg_below = torch.cumsum(neg, dim=-1) - neg
+    return (pos * (neg_below + 0.5 * neg)).sum(-1) / (pos.sum(-1) * neg.sum(-1))
+
+
+def multiclass_auc(counts):
     """
-    tru_labels, pred_probs = to_np(tru_labels), to_np(pred_probs)
-    tru_labels = tru_labels.flatten()
-    nonans_mask = ~np.isnan(tru_labels)
-    pred_probs = pred_probs.reshape([pred_probs.shape[0], -1]).transpose()
+    Computes macro one versus one and one versus rest auc from counts[j, g, i], the number of samples of class i
+    in the g-th (increasing) bin of the scores of class j. Columns past the number of classes are ignored, aucs
+    involving a class without samples are nan and left out of the averages like in sklearn's roc_auc_score
+    """
+    n_classes = len(counts)
+    counts = counts[..., :n_classes]
+    ovr = [histogram_auc(counts[j, :, j], counts[j].sum(-1) - counts[j, :, j]) for j in range(n_classes)]
+    ovo = [(histogram_auc(counts[j, :, j], counts[j, :, k]) + histogram_auc(counts[k, :, k], counts[k, :, j])) / 2
+           for j in range(n_classes) for k in range(j + 1, n_classes)]
+    return torch.nanmean(torch.stack(ovo)), torch.nanmean(torch.stack(ovr))
+
 
-    ovo = roc_auc_score(tru_labels[nonans_mask], pred_probs[nonans_mask], average='macro', multi_class='ovo')
-    ovr = roc_auc_score(tru_labels[nonans_mask], pred_probs[nonans_mask], average='macro', multi_class='ovr')
-    return ovo, ovr
+def _score_counts(scores, labels, n_classes):
+    """
+    Sorts scores once and counts the samples of every class at each distinct score, counts[g, i] is the number of
+    samples of class i with the g-th smallest distinct score (rows past the number of distinct scores stay zero and
+    column n_classes counts the samples labelled n_classes)
+    """
+    sorted_scores, order = torch.sort(scores)
+    groups = torch.cat([torch.zeros_like(order[:1]), torch.cumsum(sorted_scores[1:] != sorted_scores[:-1], dim=0)])
+    counts = torch.zeros((len(scores), n_classes + 1), dtype=torch.float64, device=scores.device)
+    return counts.index_put_((groups, labels[order]), torch.ones_like(counts[:, 0]), accumulate=True)
+
+
+def auc(tru_labels, pred_probs):
+    """
+    Computes one versus one and one versus rest auc, macro averaged over the classes occurring in tru_labels like
+    sklearn's roc_auc_score. The scores of each class are sorted once and both variants are read off the class
+    counts at each distinct score (ties count one half), on the device of the inputs
+    """
+    n_classes = len(pred_probs)
+    pred_probs = pred_probs.reshape(n_classes, -1)
+    # samples without a class are counted in an extra column that multiclass_auc ignores
+    missing = (tru_labels.flatten() == MISSING_LABEL) | torch.isnan(pred_probs).any(0)
+    tru_labels = torch.where(missing, n_classes, tru_labels.flatten().long())
+    return multiclass_auc(torch.stack([_score_counts(pred_probs[j], tru_labels, n_classes) for j in range(n_classes)]))
 
 
 def brier_score(x, y):
     """
     Computes brier score (i.e. MSE)
     """
-    return np.nanmean(np.square(x - y))
+    return torch.nanmean(torch.square(x - y))
+
+
+def brier_scores(tru_labels, pred_probs):
+    """
+    Computes the brier scores of the zero, non-zero non-excess and excess classes from the class labels (see
+    compute_class_labels) and the stacked predicted probabilities of the 3 classes, ignoring missing labels
+    """
+    missing = tru_labels == MISSING_LABEL
+    return tuple(brier_score(torch.where(missing, np.nan, (tru_labels == j).to(pred_probs.dtype)), pred_probs[j])
+                 for j in range(len(pred_probs)))
+
+
+class StreamingMetrics(nn.Module):
+    """
+    Accumulates the sufficient statistics of the evaluation metrics over the batches of an epoch. Every update runs
+    a handful of kernels on the device of the predictions and never synchronizes with the host: nan-masked sums and
+    counts of the elementwise negative log-likelihood, squared error, CRPS and Brier terms, a 3x3 confusion matrix
+    of the class labels and histograms of the predicted class probabilities split by true class. compute()
+    finalizes the metrics of all batches at once, so the additive metrics are exact and the AUCs are exact up to
+    the resolution of the histogram bins (compute_metrics instead evaluates a single batch).
+    """
+
+    def __init__(self, n_bins=10000):
+        """
+        Parameters:
+        n_bins - int, number of bins of the probability histograms used for the AUCs
+        """
+        super().__init__()
+        self.n_bins = n_bins
+        # sums and counts of nll, squared error, crps and the zero, moderate and excess brier terms
+        self.register_buffer("sums", torch.zeros(6, dtype=torch.float64), persistent=False)
+        self.register_buffer("counts", torch.zeros(6, dtype=torch.float64), persistent=False)
+        # confusion[i, j] counts samples of true class i predicted as class j
+        self.register_buffer("confusion", torch.zeros((3, 3), dtype=torch.long), persistent=False)
+        # hist[j, b, i] counts samples of true class i whose predicted probability of class j falls in bin b
+        self.register_buffer("hist", torch.zeros((3, n_bins, 3), dtype=torch.long), persistent=False)
+
+    def reset(self):
+        for buffer in self.buffers():
+            buffer.zero_()
+
+    def _add(self, i, terms):
+        terms = terms.detach().to(torch.float64)
+        mask = ~torch.isnan(terms)
+        self.sums[i] += torch.where(mask, terms, 0.).sum()
+        self.counts[i] += mask.sum()
+
+    @torch.no_grad()
+    def update(self, y, threshes, probs, point_pred, nll_terms, crps_terms):
+        """
+        Parameters:
+        y - tensor, target variable
+        threshes - tensor, thresholds defining the excess class
+        probs - tensor of shape (3,) + y.shape, predicted probabilities of the zero, moderate and excess classes
+        point_pred - tensor of the shape of y, point predictions
+        nll_terms - tensor, elementwise negative log-likelihood (or other probabilistic loss)
+        crps_terms - tensor, elementwise continuous ranked probability score
+        """
+        self._add(0, nll_terms)
+        self._add(1, torch.square(y - point_pred))
+        self._add(2, crps_terms)
+
+        labels = compute_class_labels(y, threshes)
+        for j in range(3):
+            self._add(3 + j, torch.where(labels == MISSING_LABEL, np.nan, torch.square(probs[j] - (labels == j) * 1.)))
+
+        pred_labels = compute_predicted_labels(probs)
+        self.confusion += confusion_matrix(labels, pred_labels)
+        # samples without a true or predicted class add zeros at the (arbitrary) index of class 0 and bin 0
+        valid = (labels != MISSING_LABEL) & (pred_labels != MISSING_LABEL)
+        bins = (torch.nan_to_num(probs, nan=0.) * self.n_bins).long().clamp(0, self.n_bins - 1)
+        score_class = torch.arange(3, device=bins.device).view((3,) + (1,) * labels.dim())
+        index = torch.where(valid, (score_class * self.n_bins + bins) * 3 + labels.long(), 0)
+        self.hist.view(-1).index_add_(0, index.flatten(), valid.expand_as(index).flatten().long())
+
+    def compute(self):
+        """
+        Returns:
+        metrics - dictionary of floats, nll_loss, rmse_loss, zero_brier, moderate_brier, excess_brier, acc, f1_micro,
+                  f1_macro, auc_macro_ovo, auc_macro_ovr and crps of all accumulated batches
+        """
+        means = self.sums / self.counts
+        f1_micro, f1_macro = confusion_f1(self.confusion)
+        auc_macro_ovo, auc_macro_ovr = multiclass_auc(self.hist.to(torch.float64))
+        metrics = {
+            "nll_loss": means[0],
+            "rmse_loss": torch.sqrt(means[1]),
+            "zero_brier": means[3],
+            "moderate_brier": means[4],
+            "excess_brier": means[5],
+            "acc": f1_micro,
+            "f1_micro": f1_micro,
+            "f1_macro": f1_macro,
+            "auc_macro_ovo": auc_macro_ovo,
+            "auc_macro_ovr": auc_macro_ovr,
+            "crps": means[2],
+        }
+        # the only transfer to the host
+        return dict(zip(metrics, torch.stack(list(metrics.values())).tolist()))
+
+
+class SkillMaps(nn.Module):
+    """
+    Accumulates per grid cell sufficient statistics of the evaluation metrics over the batches of an evaluation run,
+    for spatial maps of the skill over the test period. Every statistic is reduced over the samples of a batch with
+    one sum and scattered into its cells with one index_add_ on the device. compute() returns (h, w) maps of the
+    NLL, RMSE, Brier score of every class, hit rate of the excess class and reliability of the predicted excess
+    probabilities, which are nan at cells without targets.
+    """
+
+    def __init__(self, grid_shape, n_bins=10):
+        """
+        Parameters:
+        grid_shape - tuple of ints, (h, w) of the full grid
+        n_bins - int, number of probability bins of the excess reliability
+        """
+        super().__init__()
+        self.grid_shape = tuple(grid_shape)
+        self.n_bins = n_bins
+        n_cells = int(np.prod(self.grid_shape))
+        # sums and counts of nll, squared error and the zero, moderate and excess brier terms
+        self.register_buffer("sums", torch.zeros((5, n_cells), dtype=torch.float64), persistent=False)
+        self.register_buffer("counts", torch.zeros((5, n_cells), dtype=torch.float64), persistent=False)
+        # hits and misses of the excess class
+        self.register_buffer("hits", torch.zeros((2, n_cells), dtype=torch.float64), persistent=False)
+        # count, predicted excess probability and observed excesses per probability bin
+        self.register_buffer("reliability", torch.zeros((3, n_bins * n_cells), dtype=torch.float64),
+                             persistent=False)
+
+    def reset(self):
+        for buffer in self.buffers():
+            buffer.zero_()
+
+    def _scatter(self, buffer, values, cells):
+        buffer.index_add_(0, cells, values.reshape(-1, values.shape[-1]).sum(0).to(buffer.dtype))
+
+    def _add(self, i, terms, cells):
+        terms = terms.detach().to(torch.float64)
+        mask = ~torch.isnan(terms)
+        self._scatter(self.sums[i], torch.where(mask, terms, 0.), cells)
+        self._scatter(self.counts[i], mask * 1., cells)
+
+    @torch.no_grad()
+    def update(self, y, threshes, probs, point_pred, nll_terms, cells=None):
+        """
+        Parameters:
+        y - tensor, target variable whose last dim runs over the grid cells given by cells
+        threshes - tensor, thresholds defining the excess class
+        probs - tensor of shape (3,) + y.shape, predicted probabilities of the zero, moderate and excess classes
+        point_pred - tensor of the shape of y, point predictions
+        nll_terms - tensor, elementwise negative log-likelihood (or other probabilistic loss)
+        cells - tensor of ints or None, flat grid index of every cell along the last dim. Defaults to all cells
+        """
+        if cells is None:
+            cells = torch.arange(self.sums.shape[1], device=y.device)
+        self._add(0, nll_terms, cells)
+        self._add(1, torch.square(y - point_pred), cells)
+        labels = compute_class_labels(y, threshes)
+        for j in range(3):
+            self._add(2 + j, torch.where(labels == MISSING_LABEL, np.nan, torch.square(probs[j] - (labels == j) * 1.)),
+                      cells)
+
+        pred_labels = compute_predicted_labels(probs)
+        excess = (labels == 2) & (pred_labels != MISSING_LABEL)
+        self._scatter(self.hits[0], (excess & (pred_labels == 2)) * 1., cells)
+        self._scatter(self.hits[1], (excess & (pred_labels != 2)) * 1., cells)
+
+        # samples without a class or excess probability add zeros to the first bin
+        valid = ((labels != MISSING_LABEL) & ~torch.isnan(probs[2])).to(torch.float64)
+        excess_probs = torch.nan_to_num(probs[2], nan=0.).to(torch.float64)
+        bins = (excess_probs * self.n_bins).long().clamp(0, self.n_bins - 1)
+        index = (bins * self.sums.shape[1] + cells).flatten()
+        for k, values in enumerate([valid, valid * excess_probs, valid * (labels == 2)]):
+            self.reliability[k].index_add_(0, index, values.flatten())
+
+    def compute(self):
+        """
+        Returns:
+        maps - dictionary of (h, w) arrays, n_samples, nll_loss, rmse_loss, zero_brier, moderate_brier, excess_brier,
+               hit_rate and excess_reliability (the reliability term of the Brier score of the excess class)
+        """
+        means = self.sums / self.counts
+        count, prob_sum, obs_sum = self.reliability.view(3, self.n_bins, -1)
+        # sum over bins of n_k * (mean probability - observed frequency)^2 divided by the number of samples
+        bin_terms = torch.where(count > 0, torch.square(prob_sum - obs_sum) / count, 0.)
+        maps = torch.stack([
+            self.counts[2],
+            means[0],
+            torch.sqrt(means[1]),
+            means[2],
+            means[3],
+            means[4],
+            self.hits[0] / self.hits.sum(0),
+            bin_terms.sum(0) / count.sum(0),
+        ])
+        names = ["n_samples", "nll_loss", "rmse_loss", "zero_brier", "moderate_brier", "excess_brier", "hit_rate",
+                 "excess_reliability"]
+        return dict(zip(names, to_np(maps.reshape((-1,) + self.grid_shape))))
 
 
 def to_stats(y, use_evt=True):
@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from util import MixtureLoglik
+from util import _mixture_loglik
+
+
+def mixture_inputs(use_evt, seed=0, shape=(4, 1, 5, 6)):
+    """
+    Returns float64 samples, mixture parameters and thresholds covering zeros, moderate values, excesses, samples
+    equal to the threshold, nan samples and xi == 0. Without EVT the excess probability is 0 and the threshold is
+    effectively infinite, like SpatiotemporalModel does for the hurdle model
+    """
+    g = torch.Generator().manual_seed(seed)
+    rand = lambda: torch.rand(shape, generator=g, dtype=torch.float64)
+    threshes = 0.5 + rand()
+    samples = torch.exp(torch.randn(shape, generator=g, dtype=torch.float64)) * (rand() > 0.3)
+    samples.view(-1)[:4] = threshes.view(-1)[:4]
+    samples.view(-1)[4:6] = float("nan")
+    xi = rand() - 0.3
+    xi.view(-1)[::5] = 0.
+    sigma, mu, var = 0.5 + rand(), torch.randn(shape, generator=g, dtype=torch.float64), 0.3 + rand()
+    zero_probs, excess_probs = 0.1 + 0.8 * rand(), 0.1 + 0.8 * rand()
+    if not use_evt:
+        excess_probs, threshes = torch.zeros_like(excess_probs), torch.full_like(threshes, 999999999.)
+    return samples, xi, sigma, mu, var, zero_probs, excess_probs, threshes
+
+
+@pytest.mark.parametrize("use_evt", [True, False])
+def test_gradcheck(use_evt):
+    samples, *params, threshes = mixture_inputs(use_evt)
+    params = [p.requires_grad_() for p in params]
+    # nan samples give nan log-likelihoods, which must not receive (or pass on) any gradient
+    func = lambda *p: torch.nan_to_num(MixtureLoglik.apply(samples, *p, threshes))
+    assert torch.autograd.gradcheck(func, params)
+
+
+@pytest.mark.parametrize("use_evt", [True, False])
+def test_matches_autograd(use_evt):
+    samples, *params, threshes = mixture_inputs(use_evt)
+    params = [p.requires_grad_() for p in params]
+    expected = _mixture_loglik(samples, *params, threshes)
+    actual = MixtureLoglik.apply(samples, *params, threshes)
+    assert torch.allclose(actual, expected, atol=0, rtol=1e-12, equal_nan=True)
+
+    expected_grads = torch.autograd.grad(torch.nansum(expected), params)
+    actual_grads = torch.autograd.grad(torch.nansum(actual), params)
+    # autograd gives no xi gradient at xi == 0 (the xi = 0 limit is a separate branch), MixtureLoglik gives the
+    # derivative of the limit there, which test_gradcheck covers
+    xi_nonzero = params[0] != 0
+    expected_grads = (torch.where(xi_nonzero, expected_grads[0], actual_grads[0]),) + expected_grads[1:]
+    for e, a in zip(expected_grads, actual_grads):
+        assert torch.allclose(a, e, atol=1e-12, rtol=1e-10)
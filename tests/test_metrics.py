@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import f1_score
+from sklearn.metrics import roc_auc_score
+
+from util import MISSING_LABEL
+from util import auc
+from util import compute_predicted_labels
+from util import confusion_f1
+from util import confusion_matrix
+from util import f1
+
+
+def random_case(seed, n=500, ties=False, hard=False, missing=0.1, nan_probs=0.):
+    """
+    Returns int8 class labels with MISSING_LABEL entries and (3, n) class probabilities
+    """
+    rng = np.random.default_rng(seed)
+    probs = rng.dirichlet(np.ones(3), size=n).T
+    if ties:
+        probs = np.round(probs, 1)
+        probs[2] = 1 - probs[0] - probs[1]
+    if hard:
+        probs = np.eye(3)[probs.argmax(0)].T
+    labels = rng.integers(0, 3, size=n)
+    labels[rng.random(n) < missing] = MISSING_LABEL
+    probs[:, rng.random(n) < nan_probs] = np.nan
+    return labels, probs
+
+
+def sklearn_reference(labels, probs):
+    valid = (labels != MISSING_LABEL) & ~np.isnan(probs).any(0)
+    labels, probs = labels[valid], probs[:, valid].T
+    pred = probs.argmax(1)
+    return {
+        "ovo": roc_auc_score(labels, probs, average="macro", multi_class="ovo"),
+        "ovr": roc_auc_score(labels, probs, average="macro", multi_class="ovr"),
+        "f1_micro": f1_score(labels, pred, average="micro"),
+        "f1_macro": f1_score(labels, pred, average="macro"),
+    }
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("kwargs", [{}, {"ties": True}, {"hard": True}, {"nan_probs": 0.05}, {"missing": 0.}])
+def test_metrics_match_sklearn(seed, kwargs):
+    labels, probs = random_case(seed, **kwargs)
+    expected = sklearn_reference(labels, probs)
+    labels, probs = torch.tensor(labels, dtype=torch.int8), torch.tensor(probs)
+    pred_labels = compute_predicted_labels(probs)
+
+    ovo, ovr = auc(labels, probs)
+    f1_micro, f1_macro = f1(labels, pred_labels)
+    assert ovo.item() == pytest.approx(expected["ovo"], abs=1e-12)
+    assert ovr.item() == pytest.approx(expected["ovr"], abs=1e-12)
+    assert f1_micro.item() == pytest.approx(expected["f1_micro"], abs=1e-12)
+    assert f1_macro.item() == pytest.approx(expected["f1_macro"], abs=1e-12)
+
+
+def test_auc_accepts_spatial_shapes():
+    labels, probs = random_case(0)
+    flat = auc(torch.tensor(labels, dtype=torch.int8), torch.tensor(probs))
+    spatial = auc(torch.tensor(labels, dtype=torch.int8).reshape(5, 1, 10, 10),
+                  torch.tensor(probs).reshape(3, 5, 1, 10, 10))
+    assert torch.equal(torch.stack(flat), torch.stack(spatial))
+
+
+def test_confusion_f1_ignores_absent_classes():
+    # class 2 never occurs, sklearn then averages the macro f1 over classes 0 and 1 only
+    tru = np.array([0, 0, 1, 1, 1, 0])
+    pred = np.array([0, 1, 1, 1, 0, 0])
+    confusion = confusion_matrix(torch.tensor(tru, dtype=torch.int8), torch.tensor(pred, dtype=torch.int8))
+    micro, macro = confusion_f1(confusion)
+    assert micro.item() == pytest.approx(f1_score(tru, pred, average="micro"))
+    assert macro.item() == pytest.approx(f1_score(tru, pred, average="macro"))